@@ -31,6 +31,9 @@ from .config import (
     DEFAULT_MODEL
 )
 
+# The adapter puts the repository root on sys.path, so the perplexity package is importable from here on
+from perplexity import codec
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -49,6 +52,7 @@ async def lifespan(app: FastAPI):
     """Application lifespan manager"""
     global adapter
     logger.info("Starting Perplexity API Server...")
+    logger.info(f"Using JSON codec: {codec.NAME}")
     
     # Initialize adapter (will be configured per request based on API key)
     adapter = PerplexityAdapter()
@@ -12,8 +12,6 @@ from .models import (
     ChatCompletionRequest, 
     ChatCompletionResponse, 
     ChatCompletionChoice,
-    ChatCompletionStreamResponse,
-    ChatCompletionStreamChoice,
     ChatMessage,
     ChatCompletionUsage
 )
@@ -27,12 +25,56 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 try:
     import perplexity
     import perplexity_async
+    from perplexity import sse, codec
+    from perplexity.frame import Frame
 except ImportError as e:
     logging.error(f"Failed to import perplexity modules: {e}")
     raise
 
 logger = logging.getLogger(__name__)
 
+class AnswerStream:
+    """Turns the answer deltas of a search into the text chunks of an OpenAI stream
+
+    An OpenAI stream cannot retract text. After the upstream rewrites its answer (a delta with
+    'reset'), nothing is sent until the rewritten answer extends the text already sent, and
+    then only the part after it.
+    """
+
+    def __init__(self):
+        self.answer = ''  # The upstream answer so far
+        self.sent = ''  # The text sent to the client
+        self.synced = True  # Whether the answer starts with the sent text
+
+    def feed(self, delta: Dict[str, Any]) -> str:
+        """Consumes a delta and returns the text to send, possibly empty"""
+        text = delta['answer'] or ''
+
+        if delta['reset']:
+            self.answer = text
+            self.synced = self.answer.startswith(self.sent)
+            text = self.answer[len(self.sent):]
+        else:
+            self.answer += text
+
+            # While in sync the appended text is sent as is, the prefix is only compared after a rewrite
+            if not self.synced:
+                self.synced = self.answer.startswith(self.sent)
+                text = self.answer[len(self.sent):]
+
+        if not self.synced:
+            return ''
+
+        self.sent += text
+
+        return text
+
+    def finish(self):
+        """Logs a final answer that could not be streamed because it rewrote text already sent"""
+        if not self.synced:
+            logger.warning("The answer was rewritten after part of it was streamed, the rewritten answer was not sent")
+
+
 class PerplexityAdapter:
     """Adapter class to handle conversion between OpenAI and Perplexity formats"""
 
@@ -78,58 +120,31 @@ class PerplexityAdapter:
         try:
             final_answer = ""
 
-            for line in response.iter_lines():
-                if not line:
+            for event in sse.iter_events(response.iter_content()):
+                if event.type == sse.END_OF_STREAM:
+                    logger.info("Reached end of stream")
+                    break
+                elif event.type != sse.MESSAGE:
                     continue
 
-                line_str = line.decode('utf-8')
+                try:
+                    frame = Frame(event.data)
+
+                    # Look for the answer through the frame's step index
+                    answer = frame.answer
+                    if answer and len(answer) > len(final_answer):
+                        final_answer = answer
+                        logger.debug(f"Found answer: {answer[:100]}...")
 
-                if line_str.startswith('event: message'):
+                    # Check if this is the final message
+                    if frame.text_completed == True and frame.final == True:
+                        logger.info("Found final message marker")
+                        break
+
+                except json.JSONDecodeError:
                     continue
-                elif line_str.startswith('data: '):
-                    data_str = line_str[6:]  # Remove 'data: ' prefix
-
-                    try:
-                        data = json.loads(data_str)
-
-                        # Look for text field with answer
-                        if 'text' in data:
-                            text_content = data['text']
-
-                            # If text is a string, try to parse as JSON
-                            if isinstance(text_content, str):
-                                try:
-                                    parsed_text = json.loads(text_content)
-                                    if isinstance(parsed_text, dict) and 'answer' in parsed_text:
-                                        answer = parsed_text['answer']
-                                        if answer and len(answer) > len(final_answer):
-                                            final_answer = answer
-                                            logger.debug(f"Found answer: {answer[:100]}...")
-                                except json.JSONDecodeError:
-                                    pass
-                            elif isinstance(text_content, dict) and 'answer' in text_content:
-                                answer = text_content['answer']
-                                if answer and len(answer) > len(final_answer):
-                                    final_answer = answer
-                                    logger.debug(f"Found answer: {answer[:100]}...")
-
-                        # Check if this is the final message
-                        if data.get('text_completed') == True and data.get('final') == True:
-                            logger.info("Found final message marker")
-                            break
-
-                    except json.JSONDecodeError:
-                        continue
-                elif line_str.startswith('event: end_of_stream'):
-                    logger.info("Reached end of stream")
-                    break
 
             if final_answer:
-                # Decode Unicode escapes
-                try:
-                    final_answer = final_answer.encode().decode('unicode_escape')
-                except:
-                    pass
                 logger.info(f"Successfully extracted answer: {final_answer[:100]}...")
                 return final_answer
             else:
@@ -244,23 +259,25 @@ class PerplexityAdapter:
         content: str, 
         completion_id: str,
         finish_reason: Optional[str] = None
-    ) -> ChatCompletionStreamResponse:
-        """Create OpenAI format streaming chunk"""
+    ) -> str:
+        """Create OpenAI format streaming chunk as a server-sent event line
+
+        The chunk is built as a plain dict in the shape of ChatCompletionStreamResponse and
+        serialized with the shared JSON codec, skipping model validation for every chunk.
+        """
         delta = {"content": content} if content else {}
         if finish_reason:
             delta = {}
         
-        choice = ChatCompletionStreamChoice(
-            index=0,
-            delta=delta,
-            finish_reason=finish_reason
-        )
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
         
-        return ChatCompletionStreamResponse(
-            id=completion_id,
-            model=request.model,
-            choices=[choice]
-        )
+        return f"data: {codec.dumps(chunk)}\n\n"
     
     def complete_sync(self, request: ChatCompletionRequest) -> ChatCompletionResponse:
         """Synchronous completion"""
@@ -281,40 +298,9 @@ class PerplexityAdapter:
             if response is None:
                 logger.warning("Perplexity API returned None - possibly due to expired cookies or API issues")
                 content = "I apologize, but I'm currently unable to process your request due to authentication issues. The Perplexity API returned no response."
-            elif isinstance(response, dict):
-                # Try different possible response formats
-                if 'text' in response:
-                    text_data = response['text']
-                    logger.info(f"Text data type: {type(text_data)}, content: {text_data}")
-
-                    if isinstance(text_data, dict):
-                        # If text is a dict, look for answer field
-                        if 'answer' in text_data:
-                            content = text_data['answer']
-                        elif 'content' in text_data:
-                            content = text_data['content']
-                        else:
-                            content = str(text_data)
-                    elif isinstance(text_data, str):
-                        # If text is a string, try to parse as JSON
-                        try:
-                            parsed_text = json.loads(text_data)
-                            if isinstance(parsed_text, dict) and 'answer' in parsed_text:
-                                content = parsed_text['answer']
-                            else:
-                                content = text_data
-                        except json.JSONDecodeError:
-                            content = text_data
-                    else:
-                        content = str(text_data)
-                elif 'answer' in response:
-                    # Direct answer field
-                    content = response['answer']
-                else:
-                    logger.info(f"Response keys: {list(response.keys())}")
-                    content = str(response)
             else:
-                content = str(response)
+                # The client resolves the answer once from its step index
+                content = response.answer or "I apologize, but I couldn't extract a proper response from the stream."
 
             logger.info(f"Final extracted content: {content[:100]}...")
             
@@ -331,6 +317,7 @@ class PerplexityAdapter:
             query = self._convert_messages_to_query(request.messages)
             params = self._get_perplexity_params(request)
             params["stream"] = True
+            params["delta"] = True
             
             completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
             
@@ -339,15 +326,18 @@ class PerplexityAdapter:
             # Get streaming response from Perplexity
             stream = client.search(query, **params)
             
-            for chunk in stream:
-                if chunk and 'text' in chunk:
-                    content = chunk['text']
-                    stream_chunk = self._create_stream_chunk(request, content, completion_id)
-                    yield f"data: {stream_chunk.model_dump_json()}\n\n"
+            answer = AnswerStream()
+
+            for delta in stream:
+                text = answer.feed(delta)
+
+                if text:
+                    yield self._create_stream_chunk(request, text, completion_id)
+
+            answer.finish()
             
             # Send final chunk
-            final_chunk = self._create_stream_chunk(request, "", completion_id, "stop")
-            yield f"data: {final_chunk.model_dump_json()}\n\n"
+            yield self._create_stream_chunk(request, "", completion_id, "stop")
             yield "data: [DONE]\n\n"
             
         except Exception as e:
@@ -373,40 +363,9 @@ class PerplexityAdapter:
             if response is None:
                 logger.warning("Perplexity API returned None - possibly due to expired cookies or API issues")
                 content = "I apologize, but I'm currently unable to process your request due to authentication issues. The Perplexity API returned no response."
-            elif isinstance(response, dict):
-                # Try different possible response formats
-                if 'text' in response:
-                    text_data = response['text']
-                    logger.info(f"Text data type: {type(text_data)}, content: {text_data}")
-
-                    if isinstance(text_data, dict):
-                        # If text is a dict, look for answer field
-                        if 'answer' in text_data:
-                            content = text_data['answer']
-                        elif 'content' in text_data:
-                            content = text_data['content']
-                        else:
-                            content = str(text_data)
-                    elif isinstance(text_data, str):
-                        # If text is a string, try to parse as JSON
-                        try:
-                            parsed_text = json.loads(text_data)
-                            if isinstance(parsed_text, dict) and 'answer' in parsed_text:
-                                content = parsed_text['answer']
-                            else:
-                                content = text_data
-                        except json.JSONDecodeError:
-                            content = text_data
-                    else:
-                        content = str(text_data)
-                elif 'answer' in response:
-                    # Direct answer field
-                    content = response['answer']
-                else:
-                    logger.info(f"Response keys: {list(response.keys())}")
-                    content = str(response)
             else:
-                content = str(response)
+                # The client resolves the answer once from its step index
+                content = response.answer or "I apologize, but I couldn't extract a proper response from the stream."
 
             logger.info(f"Final extracted content: {content[:100]}...")
 
@@ -423,6 +382,7 @@ class PerplexityAdapter:
             query = self._convert_messages_to_query(request.messages)
             params = self._get_perplexity_params(request)
             params["stream"] = True
+            params["delta"] = True
 
             completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
 
@@ -431,15 +391,18 @@ class PerplexityAdapter:
             # Get streaming response from Perplexity
             stream = await client.search(query, **params)
 
-            async for chunk in stream:
-                if chunk and 'text' in chunk:
-                    content = chunk['text']
-                    stream_chunk = self._create_stream_chunk(request, content, completion_id)
-                    yield f"data: {stream_chunk.model_dump_json()}\n\n"
+            answer = AnswerStream()
+
+            async for delta in stream:
+                text = answer.feed(delta)
+
+                if text:
+                    yield self._create_stream_chunk(request, text, completion_id)
+
+            answer.finish()
 
             # Send final chunk
-            final_chunk = self._create_stream_chunk(request, "", completion_id, "stop")
-            yield f"data: {final_chunk.model_dump_json()}\n\n"
+            yield self._create_stream_chunk(request, "", completion_id, "stop")
             yield "data: [DONE]\n\n"
 
         except Exception as e:
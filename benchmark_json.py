@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the available JSON codecs on the SSE frames captured in `log`
+"""
+import time
+import argparse
+
+from perplexity import codec
+from benchmark_sse import load_log_frames
+
+
+def decode_frames(loads, payloads):
+    """Decode each frame the way the clients do: outer object, nested steps, FINAL answer"""
+    for payload in payloads:
+        frame = loads(payload)
+        steps = loads(frame['text'])
+
+        for step in steps:
+            if step.get('step_type') == 'FINAL':
+                loads(step['content']['answer'])
+
+    return len(payloads)
+
+
+def encode_frames(dumps, frames):
+    """Re-encode the decoded frames"""
+    for frame in frames:
+        dumps(frame)
+
+    return len(frames)
+
+
+def run(name, func, arg, total_bytes, rounds):
+    """Time one operation over several rounds and print its throughput"""
+    best = float('inf')
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+
+    print(f"{name:<18} {best * 1000:8.2f} ms  {total_bytes / best / 1e6:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log', default='log', help='Path to the captured log file')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of times the captured frames are replayed')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of timed rounds per codec')
+    args = parser.parse_args()
+
+    payloads = [
+        frame.split(b'\r\ndata: ', 1)[1]
+        for frame in load_log_frames(args.log) if frame.startswith(b'event: message')
+    ] * args.repeat
+    total_bytes = sum(len(payload) for payload in payloads)
+    frames = [codec.loads(payload) for payload in payloads]
+
+    print(f"{len(payloads)} frames, {total_bytes / 1e6:.2f} MB, default codec: {codec.NAME}")
+
+    for name in codec.CODECS:
+        try:
+            loads, dumps = codec.get(name)
+        except ImportError:
+            print(f"{name:<18} not installed")
+            continue
+
+        run(f"{name} decode", lambda payloads: decode_frames(loads, payloads), payloads, total_bytes, args.rounds)
+        run(f"{name} encode", lambda frames: encode_frames(dumps, frames), frames, total_bytes, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
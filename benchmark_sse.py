@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for SSE frame parsing, replaying the frames captured in `log`
+"""
+import ast
+import time
+import argparse
+
+from perplexity import sse
+
+LOG_PREFIX = 'Non-stream chunk: '
+
+
+def load_log_frames(path='log'):
+    """Load the raw SSE frames recorded by the client's debug prints"""
+    frames = []
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(LOG_PREFIX):
+                frame = ast.literal_eval(line[len(LOG_PREFIX):].strip())
+                if frame:
+                    frames.append(frame)
+
+    return frames
+
+
+def build_chunks(frames, chunk_size, delimiter=b'\r\n\r\n'):
+    """Rebuild the wire stream and cut it into network-sized chunks"""
+    body = delimiter.join(frames) + delimiter
+    return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+
+def legacy_parse(chunks):
+    """The previous approach: split on the delimiter, decode every frame, match prefixes"""
+    messages = 0
+    pending = None
+
+    def lines():
+        nonlocal pending
+        for chunk in chunks:
+            if pending is not None:
+                chunk = pending + chunk
+            parts = chunk.split(b'\r\n\r\n')
+            pending = parts.pop() if parts and parts[-1] and chunk and parts[-1][-1] == chunk[-1] else None
+            yield from parts
+        if pending is not None:
+            yield pending
+
+    for chunk in lines():
+        content = chunk.decode('utf-8')
+        if content.startswith('event: message\r\n'):
+            content[len('event: message\r\ndata: '):]
+            messages += 1
+        elif content.startswith('event: end_of_stream\r\n'):
+            break
+
+    return messages
+
+
+def incremental_parse(chunks):
+    """The shared incremental parser"""
+    messages = 0
+
+    for event in sse.iter_events(chunks):
+        if event.type == sse.MESSAGE:
+            messages += 1
+        elif event.type == sse.END_OF_STREAM:
+            break
+
+    return messages
+
+
+def run(name, func, chunks, total_bytes, rounds):
+    """Time a parser over several rounds and print its throughput"""
+    best = float('inf')
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        messages = func(chunks)
+        best = min(best, time.perf_counter() - start)
+
+    print(f"{name:<12} {messages:>5} messages  {best * 1000:8.2f} ms  {total_bytes / best / 1e6:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log', default='log', help='Path to the captured log file')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='Size of the simulated network reads')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of times the captured stream is replayed')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of timed rounds per parser')
+    args = parser.parse_args()
+
+    messages = [frame for frame in load_log_frames(args.log) if frame.startswith(b'event: message')]
+    frames = messages * args.repeat + [b'event: end_of_stream\r\ndata: {}']
+    chunks = build_chunks(frames, args.chunk_size)
+    total_bytes = sum(len(chunk) for chunk in chunks)
+
+    print(f"{len(frames)} frames, {total_bytes / 1e6:.2f} MB in {len(chunks)} chunks of {args.chunk_size} bytes")
+    run('legacy', legacy_parse, chunks, total_bytes, args.rounds)
+    run('incremental', incremental_parse, chunks, total_bytes, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# Importing necessary modules
+# time: Per-item deadlines
+# asyncio: Running the searches of the async client as tasks
+# concurrent.futures: Thread pool running the searches of the sync client
+import time
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Interval at which queued searches are checked for having started, when a timeout is set
+POLL_INTERVAL = 0.05
+
+
+class BatchResult:
+    '''
+    The outcome of one query of a batch.
+
+    Attributes:
+    - index: Position of the query in the input.
+    - query: The query as given (a string or a dictionary of search arguments).
+    - result: The SearchResult, or None when the search failed.
+    - error: The exception raised by the search (TimeoutError after the per-item timeout), or None.
+    '''
+
+    __slots__ = ('index', 'query', 'result', 'error')
+
+    def __init__(self, index, query, result=None, error=None):
+        self.index = index
+        self.query = query
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f'BatchResult(index={self.index!r}, ok={self.ok!r}, {self.result if self.ok else self.error!r})'
+
+
+def search_arguments(query, defaults):
+    '''
+    Merges one batch query into the search arguments shared by the batch.
+    '''
+    arguments = dict(defaults)
+
+    if isinstance(query, dict):
+        arguments.update(query)
+    else:
+        arguments['query'] = query
+
+    assert not arguments.get('stream'), 'Batched searches cannot be streamed.'
+
+    return arguments
+
+
+class SearchBatch:
+    '''
+    Iterator over the results of a batch of searches, in completion order.
+
+    Every BatchResult passing through is recorded, so failures can be inspected through
+    failures and summary() while or after iterating.
+    '''
+
+    def __init__(self, items):
+        self.total = 0
+        self.succeeded = 0
+        self.failures = {}  # index -> exception
+        self._items = items
+
+    def _record(self, item):
+        self.total += 1
+
+        if item.ok:
+            self.succeeded += 1
+        else:
+            self.failures[item.index] = item.error
+
+        return item
+
+    def summary(self):
+        '''
+        Returns the counts of finished, succeeded, failed and timed out searches, and the failures by index.
+        '''
+        return {
+            'total': self.total,
+            'succeeded': self.succeeded,
+            'failed': len(self.failures),
+            'timed_out': sum(isinstance(error, TimeoutError) for error in self.failures.values()),
+            'failures': dict(self.failures),
+        }
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._record(next(self._items))
+
+    def close(self):
+        '''
+        Stops the batch, searches that have not started yet are dropped.
+        '''
+        self._items.close()
+
+
+class AsyncSearchBatch(SearchBatch):
+    '''
+    Async iterator over the results of a batch of searches, see SearchBatch.
+    '''
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return self._record(await self._items.__anext__())
+
+    async def aclose(self):
+        '''
+        Stops the batch and cancels the searches in flight.
+        '''
+        await self._items.aclose()
+
+
+def iter_batch(search, queries, concurrency, timeout, defaults):
+    '''
+    Runs searches on a thread pool, at most concurrency at a time, and yields BatchResults as they finish.
+
+    A search that exceeds timeout is reported as TimeoutError right away. Its thread cannot be
+    interrupted, so it keeps its worker until the request itself ends; the timeout of the
+    searches queued behind it only starts once they get a worker.
+    '''
+    queries = enumerate(queries)
+    pending = {}  # future -> (index, query, start time holder)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def run(arguments, started):
+        started.append(time.monotonic())
+        return search(**arguments)
+
+    try:
+        while True:
+            # Keep at most concurrency searches in flight
+            while len(pending) < concurrency:
+                item = next(queries, None)
+                if item is None:
+                    break
+
+                index, query = item
+                try:
+                    arguments = search_arguments(query, defaults)
+                except Exception as e:
+                    yield BatchResult(index, query, error=e)
+                    continue
+
+                started = []
+                pending[executor.submit(run, arguments, started)] = (index, query, started)
+
+            if not pending:
+                return
+
+            wait_timeout = None
+
+            if timeout is not None:
+                # Searches still queued behind timed out ones are polled until they start
+                deadlines = [started[0] + timeout if started else time.monotonic() + POLL_INTERVAL for _, _, started in pending.values()]
+                wait_timeout = max(0, min(deadlines) - time.monotonic())
+
+            done, _ = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index, query, _ = pending.pop(future)
+                error = future.exception()
+
+                yield BatchResult(index, query, None if error else future.result(), error)
+
+            now = time.monotonic()
+
+            for future, (index, query, started) in list(pending.items()):
+                if timeout is not None and started and started[0] + timeout <= now and not future.done():
+                    del pending[future]
+
+                    yield BatchResult(index, query, error=TimeoutError(f'Search did not finish within {timeout} seconds.'))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def timed_search(search, arguments, timeout):
+    '''
+    Runs one search of an async batch, cancelling it and raising TimeoutError once timeout seconds passed.
+
+    Errors of the search itself, SearchTimeouts included, are raised unchanged.
+    '''
+    task = asyncio.ensure_future(search(**arguments))
+
+    try:
+        done, _ = await asyncio.wait((task,), timeout=timeout)
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    if not done:
+        raise TimeoutError(f'Search did not finish within {timeout} seconds.')
+
+    return task.result()
+
+
+async def aiter_batch(search, queries, concurrency, timeout, defaults):
+    '''
+    Runs searches as tasks, at most concurrency at a time, and yields BatchResults as they finish.
+
+    A search that exceeds timeout is cancelled and reported as TimeoutError. Closing the
+    generator cancels the searches in flight.
+    '''
+    queries = enumerate(queries)
+    pending = {}  # task -> (index, query)
+
+    try:
+        while True:
+            # Keep at most concurrency searches in flight
+            while len(pending) < concurrency:
+                item = next(queries, None)
+                if item is None:
+                    break
+
+                index, query = item
+                try:
+                    arguments = search_arguments(query, defaults)
+                except Exception as e:
+                    yield BatchResult(index, query, error=e)
+                    continue
+
+                pending[asyncio.ensure_future(timed_search(search, arguments, timeout))] = (index, query)
+
+            if not pending:
+                return
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                index, query = pending.pop(task)
+                error = task.exception()
+
+                yield BatchResult(index, query, None if error else task.result(), error)
+    finally:
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            await asyncio.wait(pending)
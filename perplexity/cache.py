@@ -0,0 +1,116 @@
+# Importing necessary modules
+# os: Atomic replacement of the on-disk store
+# time: Expiry timestamps
+# threading: Locking for uploads running on several threads
+# collections: Ordered mapping used as the LRU list
+# codec: JSON serialization of the on-disk store
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from . import codec
+
+
+class UploadCache:
+    '''
+    Content-addressed cache of uploaded attachments.
+
+    Maps (content hash, filename, MIME type) to the attachment URL returned by a previous
+    upload, so attaching the same document again costs no round trips. Entries expire after
+    ttl seconds and the least recently used entry is evicted once max_entries is reached.
+
+    Parameters:
+    - max_entries: Maximum number of cached attachments.
+    - ttl: Lifetime of an entry in seconds, or None to keep entries until they are evicted.
+    - path: Optional JSON file the cache is loaded from and written back to on every change,
+      so uploads are shared between processes and runs.
+    '''
+
+    def __init__(self, max_entries=256, ttl=3600, path=None):
+        assert max_entries > 0, 'max_entries must be positive.'
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (url, expiry timestamp or None)
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def key(digest, filename, content_type):
+        '''
+        Builds the cache key of an attachment.
+        '''
+        return f'{digest}:{content_type}:{filename}'
+
+    def get(self, key):
+        '''
+        Returns the attachment URL cached under key, or None.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                self._save()
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def set(self, key, url):
+        '''
+        Caches the attachment URL of an upload.
+        '''
+        with self._lock:
+            self._entries[key] = (url, time.time() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._save()
+
+    def clear(self):
+        '''
+        Removes every entry.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            entries = codec.loads(f.read())
+
+        now = time.time()
+
+        for key, url, expiry in entries[-self.max_entries:]:
+            if expiry is None or expiry > now:
+                self._entries[key] = (url, expiry)
+
+    def _save(self):
+        if not self.path:
+            return
+
+        # Written to a temporary file first so readers never see a partial store
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(codec.dumps([[key, url, expiry] for key, (url, expiry) in self._entries.items()]))
+
+        os.replace(tmp_path, self.path)
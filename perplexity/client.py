@@ -1,18 +1,31 @@
 # Importing necessary modules
-# re: Regular expressions for pattern matching
-# sys: System-specific parameters and functions
-# json: JSON parsing and serialization
 # random: Random number generation
-# mimetypes: Guessing MIME types of files
-# uuid: Generating unique identifiers
-# curl_cffi: HTTP requests and multipart form data handling
-import re
-import sys
-import json
+# threading: Locking shared counters and bootstrapping the session in the background
+# weakref: Tracking the open search streams
+# concurrent.futures: Thread pools for concurrent file uploads and search requests
+# protocol: Requests of a search and consumption of its response, shared with perplexity_async
+# delta: Conversion of cumulative stream snapshots into deltas
+# stream: Bounded-memory stream iterators
+# uploads: Attachment upload helpers and errors
+# cache: Content-addressed cache of uploaded attachments
+# batch: Batched searches with bounded concurrency
+# session: HTTP session with pool limits and connection reuse statistics
+# timeouts: Phase deadlines of a search
+# retry: Retries and hedged requests
 import random
-import mimetypes
-from uuid import uuid4
-from curl_cffi import requests, CurlMime
+from threading import Lock, Thread
+from weakref import WeakSet
+from concurrent.futures import ThreadPoolExecutor
+
+from . import sse, protocol
+from .delta import iter_deltas
+from .stream import SearchStream, abort_response
+from .uploads import MAX_UPLOAD_WORKERS, UploadError, file_digest, release_part, uploaded_url
+from .cache import UploadCache
+from .batch import SearchBatch, iter_batch
+from .session import Session
+from .timeouts import Timeouts, CurlTimeout, iter_chunks
+from .retry import RetryPolicy, Attempt
 
 # Importing Emailnator class for email generation
 from .emailnator import Emailnator
@@ -22,56 +35,114 @@ class Client:
     A client for interacting with the Perplexity AI API.
     '''
 
-    def __init__(self, cookies={}):
+    def __init__(self, cookies={}, upload_cache=None, limits=None, timeouts=None, retry=None):
+        '''
+        Parameters:
+        - cookies: Cookies of a Perplexity account, empty for anonymous use.
+        - upload_cache: An UploadCache (or True for an in-memory one) to reuse the URLs of identical attachments.
+        - limits: PoolLimits of the HTTP session, shared by all searches of this client.
+        - timeouts: Default Timeouts of the searches of this client.
+        - retry: A RetryPolicy retrying and hedging the searches of this client, None to send every search once.
+        '''
         # Initialize an HTTP session with default headers and optional cookies
-        self.session = requests.Session(headers={
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'accept-language': 'en-US,en;q=0.9',
-            'cache-control': 'max-age=0',
-            'dnt': '1',
-            'priority': 'u=0, i',
-            'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
-            'sec-ch-ua-arch': '"x86"',
-            'sec-ch-ua-bitness': '"64"',
-            'sec-ch-ua-full-version': '"128.0.6613.120"',
-            'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-model': '""',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-ch-ua-platform-version': '"19.0.0"',
-            'sec-fetch-dest': 'document',
-            'sec-fetch-mode': 'navigate',
-            'sec-fetch-site': 'same-origin',
-            'sec-fetch-user': '?1',
-            'upgrade-insecure-requests': '1',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-        }, cookies=cookies, impersonate='chrome')
+        self.session = Session(limits=limits, headers=protocol.HEADERS, cookies=cookies, impersonate='chrome')
 
         # Flags and counters for account and query management
         self.own = bool(cookies)  # Indicates if the client uses its own account
         self.copilot = 0 if not cookies else float('inf')  # Remaining pro queries
         self.file_upload = 0 if not cookies else float('inf')  # Remaining file uploads
+        self.lock = Lock()  # Guards the counters above against concurrent searches
 
         # Regular expression for extracting sign-in links
-        self.signin_regex = re.compile(r'"(https://www\\.perplexity\\.ai/api/auth/callback/email\\?callbackUrl=.*?)"')
+        self.signin_regex = protocol.SIGNIN_REGEX
+
+        # Cache of uploaded attachments, shared by all searches of this client
+        self.upload_cache = UploadCache() if upload_cache is True else upload_cache
+
+        # Phase deadlines used by searches that do not set their own
+        self.timeouts = timeouts or Timeouts()
+
+        # Retries and hedging of failed or slow searches, off unless a policy is given
+        self.retry = retry or RetryPolicy(attempts=1)
+
+        # Workers sending the search requests, so the wait for their first event can be bounded
+        self.executor = ThreadPoolExecutor(max_workers=self.session.limits.max_clients, thread_name_prefix='perplexity-search')
 
         # Unique timestamp for session identification
         self.timestamp = format(random.getrandbits(32), '08x')
 
-        # Initialize session by making a GET request
-        self.session.get('https://www.perplexity.ai/api/auth/session')
+        # The session is bootstrapped on first use or by warmup(), not in the constructor
+        self.bootstrapped = False
+        self.bootstrap_lock = Lock()
+
+        # Search streams that are still open, closed together with the client
+        self.streams = WeakSet()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the open search streams, releasing their responses, and the HTTP session.
+        '''
+        for stream in list(self.streams):
+            try:
+                stream.close()
+            except ValueError:
+                pass  # The stream is being read by another thread, the session close below ends it
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def warmup(self, background=False):
+        '''
+        Bootstraps the session (GET /api/auth/session) if that has not happened yet.
+
+        Parameters:
+        - background: Run the bootstrap on a daemon thread and return immediately, so several
+          clients can be warmed up in parallel. A request made meanwhile waits for it to finish.
+
+        Returns:
+        - The client itself.
+        '''
+        if self.bootstrapped:
+            return self
+
+        if background:
+            Thread(target=self.warmup, daemon=True).start()
+            return self
+
+        with self.bootstrap_lock:
+            if not self.bootstrapped:
+                self.session.get(protocol.SESSION_URL)
+                self.bootstrapped = True
+
+        return self
+
+    @property
+    def stats(self):
+        '''
+        The SessionStats of the HTTP session: requests sent, connections opened and reused, HTTP/2 use and handshake time.
+        '''
+        return self.session.stats
 
     def create_account(self, cookies):
         '''
         Creates a new account using Emailnator cookies.
         '''
+        # The sign-in request needs the CSRF cookie set by the bootstrap
+        self.warmup()
+
         while True:
             try:
                 # Initialize Emailnator client
                 emailnator_cli = Emailnator(cookies)
 
                 # Send a POST request to initiate account creation
-                resp = self.session.post('https://www.perplexity.ai/api/auth/signin/email', data={
+                resp = self.session.post(protocol.SIGNIN_URL, data={
                     'email': emailnator_cli.email,
                     'csrfToken': self.session.cookies.get_dict()['next-auth.csrf-token'].split('%')[0],
                     'callbackUrl': 'https://www.perplexity.ai/',
@@ -108,49 +179,73 @@ class Client:
         '''
         Extract the final answer text from Perplexity response data.
         '''
-        if not response_data:
-            return None
-
-        # 尝试从不同字段提取答案
-        text_content = response_data.get('text', [])
-
-        if isinstance(text_content, list):
-            # 查找包含答案的步骤
-            for step in text_content:
-                if isinstance(step, dict):
-                    step_type = step.get('step_type')
-                    if step_type in ['ANSWER', 'FINAL_ANSWER', 'RESPONSE']:
-                        content = step.get('content', {})
-                        if isinstance(content, dict) and 'text' in content:
-                            return content['text']
-                        elif isinstance(content, str):
-                            return content
-
-            # 如果没有找到特定的答案步骤，查找最后一个有内容的步骤
-            for step in reversed(text_content):
-                if isinstance(step, dict):
-                    content = step.get('content', {})
-                    if isinstance(content, dict) and 'text' in content:
-                        text = content['text']
-                        if text and len(text.strip()) > 10:  # 过滤掉太短的内容
-                            return text
-                    elif isinstance(content, str) and len(content.strip()) > 10:
-                        return content
-
-        # 如果text是字符串，直接返回
-        elif isinstance(text_content, str):
-            return text_content
-
-        # 尝试其他可能的字段
-        for field in ['answer', 'response', 'result', 'output']:
-            if field in response_data:
-                value = response_data[field]
-                if isinstance(value, str) and value.strip():
-                    return value
-
-        return None
-
-    def search(self, query, mode='auto', model=None, sources=['web'], files={}, stream=False, language='en-US', follow_up=None, incognito=False):
+        return protocol.extract_answer(response_data)
+
+    def upload_file(self, filename, file):
+        '''
+        Uploads a single file and returns its attachment URL.
+        '''
+        file_type, file_size, part = protocol.upload_part(filename, file)
+
+        try:
+            # Reuse the attachment URL of identical content uploaded earlier
+            if self.upload_cache is not None:
+                cache_key = self.upload_cache.key(file_digest(part), filename, file_type)
+                cached_url = self.upload_cache.get(cache_key)
+
+                if cached_url:
+                    return cached_url
+
+            file_upload_info = self.session.post(protocol.UPLOAD_URL, json=protocol.upload_url_payload(filename, file_type, file_size)).json()
+
+            # Upload the file to the server
+            mp = protocol.upload_multipart(file_upload_info, filename, file_type, part)
+
+            upload_resp = self.session.post(file_upload_info['s3_bucket_url'], multipart=mp)
+        finally:
+            # Spooled file objects are deleted once sent
+            release_part(part)
+
+        if not upload_resp.ok:
+            raise Exception('File upload error', upload_resp)
+
+        # Extract the uploaded file URL
+        url = uploaded_url(file_upload_info, upload_resp)
+
+        if self.upload_cache is not None:
+            self.upload_cache.set(cache_key, url)
+
+        return url
+
+    def upload_files(self, files, max_workers=MAX_UPLOAD_WORKERS):
+        '''
+        Uploads files concurrently and returns their attachment URLs in the order of files.
+
+        Parameters:
+        - files: Dictionary mapping filenames to file contents, paths or file objects.
+        - max_workers: Maximum number of uploads running at the same time.
+
+        Raises UploadError with every failed upload once all of them have finished.
+        '''
+        # A single file is uploaded on the calling thread
+        if len(files) == 1:
+            filename, file = next(iter(files.items()))
+            try:
+                return [self.upload_file(filename, file)]
+            except Exception as e:
+                raise UploadError({filename: e}) from e
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+            futures = {filename: executor.submit(self.upload_file, filename, file) for filename, file in files.items()}
+
+        errors = {filename: future.exception() for filename, future in futures.items() if future.exception() is not None}
+
+        if errors:
+            raise UploadError(errors)
+
+        return [future.result() for future in futures.values()]
+
+    def search(self, query, mode='auto', model=None, sources=['web'], files={}, stream=False, language='en-US', follow_up=None, incognito=False, delta=False, max_chunks=1, timeouts=None):
         '''
         Executes a search query on Perplexity AI.
 
@@ -159,180 +254,124 @@ class Client:
         - mode: Search mode ('auto', 'pro', 'reasoning', 'deep research').
         - model: Specific model to use for the query.
         - sources: List of sources ('web', 'scholar', 'social').
-        - files: Dictionary of files to upload.
+        - files: Dictionary mapping filenames to file contents, paths or file objects to upload.
         - stream: Whether to stream the response.
         - language: Language code (ISO 639).
         - follow_up: Information for follow-up queries.
         - incognito: Whether to enable incognito mode.
+        - delta: When streaming, yield only newly appended answer text and new steps instead of full snapshots.
+        - max_chunks: Number of snapshots retained by a stream (None keeps all of them).
+        - timeouts: Timeouts of this search, defaults to the ones of the client. Exceeding one raises
+          ConnectTimeout, FirstEventTimeout, IdleTimeout or TotalTimeout (all SearchTimeout subclasses).
         '''
         # Validate input parameters
-        assert mode in ['auto', 'pro', 'reasoning', 'deep research'], 'Invalid search mode.'
-        assert model in {
-            'auto': [None],
-            'pro': [None, 'sonar', 'gpt-4.5', 'gpt-4o', 'claude 3.7 sonnet', 'gemini 2.0 flash', 'grok-2'],
-            'reasoning': [None, 'r1', 'o3-mini', 'claude 3.7 sonnet'],
-            'deep research': [None]
-        }[mode] if self.own else True, 'Invalid model for the selected mode.'
-        assert all([source in ('web', 'scholar', 'social') for source in sources]), 'Invalid sources.'
-        assert self.copilot > 0 if mode in ['pro', 'reasoning', 'deep research'] else True, 'No remaining pro queries.'
-        assert self.file_upload - len(files) >= 0 if files else True, 'File upload limit exceeded.'
-
-        # Update query and file upload counters
-        self.copilot = self.copilot - 1 if mode in ['pro', 'reasoning', 'deep research'] else self.copilot
-        self.file_upload = self.file_upload - len(files) if files else self.file_upload
-
-        # Upload files and prepare the query payload
-        uploaded_files = []
-        for filename, file in files.items():
-            file_type = mimetypes.guess_type(filename)[0]
-            file_upload_info = (self.session.post(
-                'https://www.perplexity.ai/rest/uploads/create_upload_url?version=2.18&source=default',
-                json={
-                    'content_type': file_type,
-                    'file_size': sys.getsizeof(file),
-                    'filename': filename,
-                    'force_image': False,
-                    'source': 'default',
-                }
-            )).json()
+        protocol.check_search(mode, model, sources, self.own)
 
-            # Upload the file to the server
-            mp = CurlMime()
-            for key, value in file_upload_info['fields'].items():
-                mp.addpart(name=key, data=value)
-            mp.addpart(name='file', content_type=file_type, filename=filename, data=file)
+        with self.lock:
+            # Update query and file upload counters
+            self.copilot, self.file_upload = protocol.charge_search(mode, files, self.copilot, self.file_upload)
 
-            upload_resp = self.session.post(file_upload_info['s3_bucket_url'], multipart=mp)
+        # Bootstrap the session in the background while the files are uploaded
+        if files:
+            self.warmup(background=True)
+
+        # Upload files concurrently and prepare the query payload
+        uploaded_files = self.upload_files(files) if files else []
+        json_data = protocol.search_payload(query, mode, model, sources, uploaded_files, language, follow_up, incognito)
+
+        # Send the query request once the session is bootstrapped and handle the response
+        self.warmup()
 
-            if not upload_resp.ok:
-                raise Exception('File upload error', upload_resp)
-
-            # Extract the uploaded file URL
-            if 'image/upload' in file_upload_info['s3_object_url']:
-                uploaded_url = re.sub(
-                    r'/private/s--.*?--/v\\d+/user_uploads/',
-                    '/private/user_uploads/',
-                    upload_resp.json()['secure_url']
-                )
-            else:
-                uploaded_url = file_upload_info['s3_object_url']
-
-            uploaded_files.append(uploaded_url)
-
-        # Prepare the JSON payload for the query
-        json_data = {
-            'query_str': query,
-            'params': {
-                'attachments': uploaded_files + follow_up['attachments'] if follow_up else uploaded_files,
-                'frontend_context_uuid': str(uuid4()),
-                'frontend_uuid': str(uuid4()),
-                'is_incognito': incognito,
-                'language': language,
-                'last_backend_uuid': follow_up['backend_uuid'] if follow_up else None,
-                'mode': 'concise' if mode == 'auto' else 'copilot',
-                'model_preference': {
-                    'auto': { None: 'turbo' },
-                    'pro': {
-                        None: 'pplx_pro',
-                        'sonar': 'experimental',
-                        'gpt-4.5': 'gpt45',
-                        'gpt-4o': 'gpt4o',
-                        'claude 3.7 sonnet': 'claude2',
-                        'gemini 2.0 flash': 'gemini2flash',
-                        'grok-2': 'grok'
-                    },
-                    'reasoning': {
-                        None: 'pplx_reasoning',
-                        'r1': 'r1',
-                        'o3-mini': 'o3mini',
-                        'claude 3.7 sonnet': 'claude37sonnetthinking'
-                    },
-                    'deep research': { None: 'pplx_alpha' }
-                }[mode][model],
-                'source': 'default',
-                'sources': sources,
-                'version': '2.18'
-            }
-        }
-
-        # Send the query request and handle the response
-        resp = self.session.post('https://www.perplexity.ai/rest/sse/perplexity_ask', json=json_data, stream=True, timeout=60)
-        # print(f"Response object received: {resp}") # Debug print
-        chunks = []
+        # The requests run on the workers up to their first event, so slow ones can be given up or hedged
+        attempt = self.retry.run(mode, lambda deadline: self.executor.submit(self._open_search, json_data, deadline), timeouts or self.timeouts, abort_response)
+        resp, deadline = attempt.resp, attempt.deadline
+        reader = protocol.SearchReader()
 
         def stream_response(resp):
             '''
             Generator for streaming responses.
             '''
-            for chunk in resp.iter_lines(delimiter=b'\r\n\r\n'):
-                # print(f"Streamed chunk: {chunk}") # Debug print
-                content = chunk.decode('utf-8')
-
-                if content.startswith('event: message\r\n'):
-                    content_json = json.loads(content[len('event: message\r\ndata: '):])
-                    content_json['text'] = json.loads(content_json['text'])
+            try:
+                for event in attempt:
+                    frame = reader.receive(event)
 
-                    chunks.append(content_json)
-                    yield chunks[-1]
+                    if frame is not None:
+                        deadline.event()
+                        yield frame
 
-                elif content.startswith('event: end_of_stream\r\n'):
-                    return
+                    if reader.done:
+                        return
+            finally:
+                # Stop the transfer right away, also when the consumer closes the stream early
+                abort_response(resp)
 
         if stream:
-            return stream_response(resp)
-
-        # print("Entering non-stream mode iteration.") # Debug print
-        final_answer = None
-
-        for chunk in resp.iter_lines(delimiter=b'\r\n\r\n'):
-            # print(f"Non-stream chunk: {chunk}") # Debug print
-            content = chunk.decode('utf-8')
-
-            if content.startswith('event: message\r\n'):
-                try:
-                    content_json = json.loads(content[len('event: message\r\ndata: '):])
-                    content_json['text'] = json.loads(content_json['text'])
-                    chunks.append(content_json)
-
-                    # 检查是否包含最终答案
-                    if content_json.get('text_completed', False) or content_json.get('status') == 'completed':
-                        final_answer = content_json
-                        # print(f"Found final answer: {final_answer.get('text', 'No text field')}")
-
-                except json.JSONDecodeError as e:
-                    # print(f"JSON decode error: {e}")
-                    continue
-
-            elif content.startswith('event: end_of_stream\r\n'):
-                # print("End of stream detected.")
-                break
-
-        # print("Exiting non-stream mode iteration.") # Debug print
-
-        # 返回最终答案，如果没有找到则返回最后一个chunk
-        result_data = final_answer if final_answer else (chunks[-1] if chunks else None)
-
-        if result_data:
-            # 尝试提取可读的答案文本
-            extracted_answer = self.extract_answer(result_data)
-            if extracted_answer:
-                # print(f"Extracted answer: {extracted_answer[:200]}...")
-                return {
-                    'answer': extracted_answer,
-                    'raw_data': result_data,
-                    'status': 'success'
-                }
-            else:
-                # print("Could not extract readable answer, returning raw data")
-                return {
-                    'answer': None,
-                    'raw_data': result_data,
-                    'status': 'no_answer_extracted'
-                }
-        else:
-            # print("No chunks received!")
-            return {
-                'answer': None,
-                'raw_data': None,
-                'status': 'no_response'
-            }
\ No newline at end of file
+            search_stream = SearchStream(iter_deltas(stream_response(resp)) if delta else stream_response(resp), max_chunks, resp)
+            self.streams.add(search_stream)
+
+            return search_stream
+
+        try:
+            for event in attempt:
+                if reader.receive(event) is not None:
+                    deadline.event()
+
+                # Return as soon as the final frame arrives
+                if reader.done:
+                    break
+        finally:
+            # Stop the transfer instead of draining trailing bytes
+            abort_response(resp)
+
+        return reader.result()
+
+    def _open_search(self, json_data, deadline):
+        '''
+        Sends a search request and reads its stream up to the first event.
+
+        Returns:
+        - An Attempt holding the response and its events.
+        '''
+        # Time spent waiting for a worker does not count against the first event timeout
+        deadline.begin()
+
+        json_data = protocol.attempt_payload(json_data)
+
+        try:
+            resp = self.session.post(protocol.SEARCH_URL, json=json_data, stream=True, timeout=deadline.timeouts.curl_timeout())
+        except CurlTimeout as e:
+            raise deadline.transport_error(e) from e
+
+        events = sse.iter_events(iter_chunks(resp, deadline))
+
+        try:
+            for event in events:
+                if event.type == sse.MESSAGE:
+                    deadline.event()
+                    return Attempt(resp, deadline, event, events)
+
+                elif event.type == sse.END_OF_STREAM:
+                    break
+        except BaseException:
+            abort_response(resp)
+            raise
+
+        return Attempt(resp, deadline)
+
+    def search_many(self, queries, concurrency=4, timeout=None, **kwargs):
+        '''
+        Runs a batch of searches on a thread pool.
+
+        Parameters:
+        - queries: Iterable of query strings, or of dictionaries of search arguments.
+        - concurrency: Maximum number of searches running at the same time.
+        - timeout: Seconds after which a single search is reported as failed with TimeoutError.
+        - kwargs: Search arguments shared by every query (mode, sources, ...), streaming is not supported.
+
+        Returns:
+        - A SearchBatch yielding a BatchResult (index, query, result, error) per query in completion order.
+          Its summary() reports the failures.
+        '''
+        assert concurrency > 0, 'concurrency must be positive.'
+
+        return SearchBatch(iter_batch(self.search, queries, concurrency, timeout, kwargs))
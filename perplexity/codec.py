@@ -0,0 +1,87 @@
+# Importing necessary modules
+# os: Reading the codec override from the environment
+# json: Standard library fallback codec
+import os
+import json
+
+# Codecs in order of preference, PERPLEXITY_JSON_CODEC forces one of them
+CODECS = ('orjson', 'msgspec', 'json')
+
+
+def _load_orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    # orjson.JSONDecodeError already subclasses json.JSONDecodeError
+    return orjson.loads, dumps
+
+
+def _load_msgspec():
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder()
+
+    def loads(data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), data if isinstance(data, str) else '', 0) from None
+
+    def dumps(obj):
+        return encoder.encode(obj).decode('utf-8')
+
+    return loads, dumps
+
+
+def _load_json():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    return json.loads, encoder.encode
+
+
+_LOADERS = {'orjson': _load_orjson, 'msgspec': _load_msgspec, 'json': _load_json}
+
+NAME = None
+loads = None
+dumps = None
+
+
+def get(name):
+    '''
+    Returns the (loads, dumps) pair of a codec, raising ImportError when it is not installed.
+    '''
+    assert name in _LOADERS, f'JSON codecs -> {list(CODECS)}'
+
+    return _LOADERS[name]()
+
+
+def use(name=None):
+    '''
+    Selects the JSON codec used by the clients and the API server.
+
+    Parameters:
+    - name: One of CODECS, or None to pick the fastest installed one.
+
+    Returns:
+    - The name of the selected codec.
+
+    Every codec raises json.JSONDecodeError on invalid input, and dumps returns compact str.
+    '''
+    global NAME, loads, dumps
+
+    for candidate in ([name] if name else CODECS):
+        try:
+            loads, dumps = get(candidate)
+        except ImportError:
+            if name:
+                raise
+            continue
+
+        NAME = candidate
+        return NAME
+
+
+use(os.environ.get('PERPLEXITY_JSON_CODEC') or None)
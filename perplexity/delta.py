@@ -0,0 +1,145 @@
+# Importing necessary modules
+# steps: Index of the latest step of each type
+from .steps import StepIndex
+
+
+class DeltaTracker:
+    '''
+    Turns the cumulative snapshots of a search stream into deltas.
+
+    Every 'message' frame resends the whole step list, so the tracker remembers the
+    answer text and the number of steps already seen and reports only what was appended.
+    The step index is kept up to date as frames arrive.
+    '''
+
+    def __init__(self):
+        self.answer = ''
+        self.step_count = 0
+        self.index = StepIndex()
+
+    def update(self, frame):
+        '''
+        Consumes one decoded frame and returns its delta, or None when nothing changed.
+
+        The delta is a dictionary with the keys:
+        - answer: Newly appended answer text.
+        - steps: Steps that were not present in the previous frame.
+        - reset: True when the answer was rewritten and 'answer' holds the full text.
+        - status: The frame status.
+        - final: Whether this is the completing frame.
+        - backend_uuid, attachments: Follow-up information, present on the final delta.
+        - sources: The web results cited by the answer, present on the final delta.
+        '''
+        text = frame.get('text')
+        steps = text if isinstance(text, list) else []
+
+        self.index.update(text)
+        answer = self.index.answer or self.answer
+        final = bool(frame.get('final_sse_message') or frame.get('status') == 'completed')
+
+        reset = not answer.startswith(self.answer)
+        new_answer = answer if reset else answer[len(self.answer):]
+        new_steps = steps[self.step_count:] if len(steps) > self.step_count else []
+
+        self.answer = answer
+        self.step_count = max(self.step_count, len(steps))
+
+        if not (new_answer or new_steps or reset or final):
+            return None
+
+        delta = {
+            'answer': new_answer,
+            'steps': new_steps,
+            'reset': reset,
+            'status': frame.get('status'),
+            'final': final,
+        }
+
+        if final:
+            delta['backend_uuid'] = frame.get('backend_uuid')
+            delta['attachments'] = frame.get('attachments', [])
+            delta['sources'] = self.index.sources
+
+        return delta
+
+
+class LabsDeltaTracker:
+    '''
+    Turns the cumulative answers of a Labs query into deltas.
+
+    Every answer resends the whole output, so the tracker remembers the text already seen
+    and reports only what was appended, along with the other fields of the answer
+    (citations, status, ...) when they change.
+    '''
+
+    # Fields never reported as metadata: the output itself and its cumulative token chunks
+    SKIPPED = ('output', 'chunks')
+
+    def __init__(self):
+        self.output = ''
+        self.fields = {}
+
+    def update(self, answer):
+        '''
+        Consumes one answer and returns its delta, or None when nothing changed.
+
+        The delta is a dictionary with the keys:
+        - output: Newly appended output text.
+        - reset: True when the output was rewritten and 'output' holds the full text.
+        - final: Whether this is the final answer.
+        - Every other field of the answer whose value changed since the previous delta.
+        '''
+        output = answer.get('output') or ''
+        final = bool(answer.get('final'))
+
+        reset = not output.startswith(self.output)
+        new_output = output if reset else output[len(self.output):]
+        self.output = output
+
+        changed = {key: value for key, value in answer.items() if key not in self.SKIPPED and key != 'final' and self.fields.get(key) != value}
+        self.fields.update(changed)
+
+        if not (new_output or reset or final or changed):
+            return None
+
+        return {'output': new_output, 'reset': reset, 'final': final, **changed}
+
+
+def iter_deltas(frames, tracker=None):
+    '''
+    Converts an iterable of decoded frames into a generator of deltas.
+    Closing the generator closes frames, so the underlying response is released.
+
+    Parameters:
+    - tracker: The tracker turning the frames into deltas, a DeltaTracker by default.
+    '''
+    tracker = tracker or DeltaTracker()
+
+    try:
+        for frame in frames:
+            delta = tracker.update(frame)
+
+            if delta is not None:
+                yield delta
+    finally:
+        if hasattr(frames, 'close'):
+            frames.close()
+
+
+async def aiter_deltas(frames, tracker=None):
+    '''
+    Converts an async iterable of decoded frames into an async generator of deltas.
+    Closing the generator closes frames, so the underlying response is released.
+    See iter_deltas for tracker.
+    '''
+    tracker = tracker or DeltaTracker()
+
+    try:
+        async for frame in frames:
+            delta = tracker.update(frame)
+
+            if delta is not None:
+                yield delta
+    finally:
+        if hasattr(frames, 'aclose'):
+            await frames.aclose()
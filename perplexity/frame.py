@@ -0,0 +1,245 @@
+# Importing necessary modules
+# re: Byte-level scanning for completion markers
+# json: Decode error type shared by all codecs
+# codec: JSON parsing of frame payloads
+import re
+import json
+
+from . import codec
+from .steps import StepIndex
+
+# Finds frames that may carry a completion marker without decoding them. Nested objects
+# (plan steps, sources_mode_rows, ...) are not escaped and can hold the same keys, so a match
+# is only a candidate, confirmed on the decoded top-level fields.
+COMPLETION_MARKER = re.compile(rb'"(?:text_completed|final_sse_message)":\s*true|"status":\s*"completed"')
+
+# Finds candidates for the last frame of a stream, after which nothing useful follows
+FINAL_MARKER = re.compile(rb'"final_sse_message":\s*true|"status":\s*"completed"')
+
+# Fields kept on a decoded frame, everything else stays in the raw payload
+FIELDS = (
+    'uuid', 'backend_uuid', 'context_uuid', 'frontend_context_uuid', 'status', 'text_completed',
+    'final_sse_message', 'final', 'mode', 'display_model', 'thread_url_slug', 'attachments',
+)
+
+_FLAGS = ('text_completed', 'final_sse_message', 'final')
+
+_UNSET = object()
+
+
+class Frame:
+    '''
+    A lazily decoded 'message' frame of a search stream.
+
+    The raw payload is kept as bytes. On first access to one of FIELDS the frame is decoded
+    once, the common fields are stored in slots and the rest of the decoded object is
+    dropped; the nested 'text' document and its step index are built separately, again on
+    first access. Uncommon fields are read back from the raw payload
+    through data, and item access (frame['status']) is kept for dictionary-style callers.
+    '''
+
+    __slots__ = ('raw', '_text', '_steps', '_index') + FIELDS
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._text = _UNSET
+        self._steps = _UNSET
+        self._index = None
+
+    def __getattr__(self, name):
+        # Only reached while a field slot is still empty, i.e. before the first decode
+        if name not in FIELDS:
+            raise AttributeError(name)
+
+        self._decode()
+
+        return object.__getattribute__(self, name)
+
+    def _decode(self):
+        data = codec.loads(self.raw)
+
+        for name in FIELDS:
+            setattr(self, name, data.get(name, False if name in _FLAGS else None))
+
+        self._text = data.get('text')
+
+    @property
+    def is_completing(self):
+        '''
+        Whether the frame carries a top-level completion marker. Frames without any marker are not decoded.
+        '''
+        if COMPLETION_MARKER.search(self.raw) is None:
+            return False
+
+        return self.text_completed is True or self.final_sse_message is True or self.status == 'completed'
+
+    @property
+    def is_final(self):
+        '''
+        Whether the frame is the last one of the stream, confirmed on its top-level fields like is_completing.
+        '''
+        if FINAL_MARKER.search(self.raw) is None:
+            return False
+
+        return self.final_sse_message is True or self.status == 'completed'
+
+    @property
+    def data(self):
+        '''
+        The whole frame decoded from the raw payload, with 'text' still serialized.
+        '''
+        return codec.loads(self.raw)
+
+    @property
+    def steps(self):
+        '''
+        The decoded 'text' field, usually the list of steps.
+        '''
+        if self._steps is _UNSET:
+            if self._text is _UNSET:
+                self._decode()
+
+            text = self._text
+
+            if isinstance(text, str):
+                try:
+                    text = codec.loads(text)
+                except json.JSONDecodeError:
+                    pass
+
+            self._steps = text
+            self._text = None
+
+        return self._steps
+
+    @property
+    def index(self):
+        '''
+        The StepIndex of the frame's steps.
+        '''
+        if self._index is None:
+            self._index = StepIndex(self.steps)
+
+        return self._index
+
+    @property
+    def answer(self):
+        '''
+        The answer text carried by the frame, or None.
+        '''
+        return self.index.answer
+
+    @property
+    def sources(self):
+        '''
+        The web results cited by the answer.
+        '''
+        return self.index.sources
+
+    def get(self, key, default=None):
+        '''
+        Returns a field of the frame, decoding it on first use.
+        '''
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            return getattr(self, key)
+
+        if key == 'text':
+            return self.steps
+
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in FIELDS or key == 'text' or key in self.data
+
+    def to_dict(self):
+        '''
+        Returns the fully decoded frame as a dictionary.
+        '''
+        data = self.data
+
+        if 'text' in data:
+            data['text'] = self.steps
+
+        return data
+
+    def __repr__(self):
+        return f'Frame(status={self.status!r}, final={self.final_sse_message!r}, <{len(self.raw)} bytes>)'
+
+
+class SearchResult:
+    '''
+    The result of a non-stream search.
+
+    Attributes:
+    - answer: The extracted answer text, or None.
+    - sources: The web results cited by the answer.
+    - status: 'success', 'no_answer_extracted' or 'no_response'.
+    - frame: The Frame the result was built from, or None.
+
+    Item access is kept for the keys of the previous dictionary result ('answer', 'raw_data',
+    'status') and for the follow-up keys ('backend_uuid', 'attachments'), so a result can be
+    passed directly as follow_up to the next search. Other keys ('text', 'uuid', ...) are read
+    from the frame, like on the raw last chunk the async client used to return; its top-level
+    'status' is result.frame['status'].
+    '''
+
+    __slots__ = ('answer', 'status', 'frame')
+
+    KEYS = ('answer', 'status', 'raw_data', 'backend_uuid', 'attachments', 'sources')
+
+    def __init__(self, answer, status, frame):
+        self.answer = answer
+        self.status = status
+        self.frame = frame
+
+    @property
+    def raw_data(self):
+        '''
+        The fully decoded frame, or None.
+        '''
+        return self.frame.to_dict() if self.frame is not None else None
+
+    @property
+    def sources(self):
+        return self.frame.sources if self.frame is not None else []
+
+    @property
+    def backend_uuid(self):
+        return self.frame.backend_uuid if self.frame is not None else None
+
+    @property
+    def attachments(self):
+        return (self.frame.attachments or []) if self.frame is not None else []
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+
+        if self.frame is None:
+            raise KeyError(key)
+
+        return self.frame[key]
+
+    def __contains__(self, key):
+        return key in self.KEYS or (self.frame is not None and key in self.frame)
+
+    def to_dict(self):
+        '''
+        Returns the result in the previous dictionary form.
+        '''
+        return {'answer': self.answer, 'raw_data': self.raw_data, 'status': self.status}
+
+    def __repr__(self):
+        return f'SearchResult(status={self.status!r}, answer={self.answer!r})'
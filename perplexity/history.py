@@ -0,0 +1,158 @@
+# Importing necessary modules
+# codec: JSON serialization of the messages
+from . import codec
+
+# Rough number of characters per token, used to estimate the size of a message
+CHARS_PER_TOKEN = 4
+
+
+def approx_tokens(encoded):
+    '''
+    Estimates the number of tokens of a JSON encoded message.
+    '''
+    return len(encoded) // CHARS_PER_TOKEN + 1
+
+
+def _role(message):
+    return message.get('role') if isinstance(message, dict) else None
+
+
+class History:
+    '''
+    The conversation of a LabsClient and the window of it sent with each query.
+
+    Every message is encoded to JSON once, when it is added, and the encoded messages are
+    joined into the array sent with a query, so unchanged history is never re-encoded. By
+    default the whole conversation is sent. Otherwise the window holds the most recent turns
+    (a user message and the answer that follows it) that fit in max_turns and in an approximate
+    max_tokens budget; with pin_system, system messages are always sent first, whatever their age.
+    The query being sent is always part of the window, even when it alone exceeds the budget.
+
+    The history behaves like the list of messages it replaces: it can be iterated, indexed,
+    extended and cleared.
+    '''
+
+    __slots__ = ('max_turns', 'max_tokens', 'pin_system', 'messages', '_encoded', '_tokens')
+
+    def __init__(self, messages=(), max_turns=None, max_tokens=None, pin_system=True):
+        '''
+        Parameters:
+        - messages: Messages the conversation starts with, system prompts for instance.
+        - max_turns: Maximum number of turns sent with a query, None for no limit.
+        - max_tokens: Approximate maximum number of tokens sent with a query, None for no limit.
+        - pin_system: Whether the system messages are sent with every query.
+        '''
+        assert max_turns is None or max_turns > 0, 'max_turns must be positive.'
+        assert max_tokens is None or max_tokens > 0, 'max_tokens must be positive.'
+
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.pin_system = pin_system
+
+        self.messages = []
+        self._encoded = []  # JSON of each message
+        self._tokens = []  # Estimated tokens of each message
+
+        self.extend(messages)
+
+    def append(self, message):
+        '''
+        Adds a message at the end of the conversation.
+        '''
+        encoded = codec.dumps(message)
+
+        self.messages.append(message)
+        self._encoded.append(encoded)
+        self._tokens.append(approx_tokens(encoded))
+
+    def extend(self, messages):
+        '''
+        Adds messages at the end of the conversation.
+        '''
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        '''
+        Removes every message but the pinned system messages.
+        '''
+        kept = [message for message in self.messages if self._pinned(message)]
+
+        self.messages, self._encoded, self._tokens = [], [], []
+        self.extend(kept)
+
+    def _pinned(self, message):
+        return self.pin_system and _role(message) == 'system'
+
+    def window(self, query=None):
+        '''
+        Returns the indexes of the messages sent with a query.
+
+        Parameters:
+        - query: JSON of the message sent after the history, counted in the token budget.
+        '''
+        budget = self.max_tokens
+        turns = self.max_turns
+
+        # The query opens a turn of its own
+        if turns is not None and query is not None:
+            turns -= 1
+
+        if budget is not None and query is not None:
+            budget -= approx_tokens(query)
+
+        pinned = [index for index, message in enumerate(self.messages) if self._pinned(message)] if self.pin_system else []
+
+        if budget is not None:
+            budget -= sum(self._tokens[index] for index in pinned)
+
+        # Walk back from the latest message while the turns and the budget allow it
+        start = len(self.messages)
+
+        while start > 0:
+            index = start - 1
+            message = self.messages[index]
+
+            if self._pinned(message):
+                start = index
+                continue
+
+            if budget is not None:
+                if self._tokens[index] > budget:
+                    break
+
+                budget -= self._tokens[index]
+
+            if _role(message) == 'user' and turns is not None:
+                if turns == 0:
+                    break
+
+                turns -= 1
+
+            start = index
+
+        # The window never starts with an answer whose question was cut off
+        while start < len(self.messages) and not self._pinned(self.messages[start]) and _role(self.messages[start]) != 'user':
+            start += 1
+
+        return [index for index in pinned if index < start] + list(range(start, len(self.messages)))
+
+    def encode(self, query):
+        '''
+        Returns the JSON array of the messages sent with a query, the query message included.
+        '''
+        encoded = codec.dumps(query)
+
+        return '[' + ','.join([self._encoded[index] for index in self.window(encoded)] + [encoded]) + ']'
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __repr__(self):
+        return f'History({len(self.messages)} messages, max_turns={self.max_turns!r}, max_tokens={self.max_tokens!r})'
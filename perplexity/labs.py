@@ -1,27 +1,59 @@
 # Importing necessary modules
 # ssl: SSL/TLS support for secure connections
-# json: JSON parsing and serialization
-# time: Time-related functions for delays
+# time: Measuring the connection deadline and the time since the last message
 # socket: Low-level networking interface
 # random: Random number generation
-# threading: For running background tasks
+# threading: For running background tasks and guarding the connection setup and the router
+# queue: Answer queues of the queries
+# concurrent.futures: Opening the WebSocket connection during the HTTP handshake
 # curl_cffi: HTTP requests
 # websocket: WebSocket client for real-time communication
+# codec: JSON parsing and serialization
+# timeouts: Connection and answer deadlines
+# multiplex: Routing of the answers to concurrent queries
+# history: Window of the conversation sent with each query
+# delta: Conversion of the cumulative answers into deltas
 import ssl
-import json
 import time
 import socket
 import random
-from threading import Thread
+from threading import Lock, Thread, Event
+from queue import SimpleQueue, Empty
+from concurrent.futures import ThreadPoolExecutor
 from curl_cffi import requests
 from websocket import WebSocketApp
 
+from . import codec
+from .timeouts import Timeouts, ConnectTimeout, CurlTimeout
+from .multiplex import LabsRequest, LabsRouter, CLOSED, SENT
+from .history import History
+from .delta import iter_deltas, LabsDeltaTracker
+
+def open_socket(timeout=None):
+    '''
+    Opens the TLS connection used by the Labs WebSocket, giving up after timeout seconds.
+    '''
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+
+    sock = context.wrap_socket(socket.create_connection(('www.perplexity.ai', 443), timeout=timeout), server_hostname='www.perplexity.ai')
+
+    # The timeout only covers the handshakes, the WebSocket itself stays open while idle
+    sock.settimeout(None)
+
+    return sock
+
 class LabsClient:
     '''
     A client for interacting with the Perplexity AI Labs API.
     '''
 
-    def __init__(self):
+    def __init__(self, timeouts=None, history=None):
+        '''
+        Parameters:
+        - timeouts: Default Timeouts of the connection and of the queries of this client.
+        - history: A History limiting the turns or tokens of the conversation sent with each query, None sends all of it.
+        '''
         # Initialize HTTP session with default headers
         self.session = requests.Session(headers={
             'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
@@ -49,107 +81,288 @@ class LabsClient:
         # Generate a unique timestamp for session identification
         self.timestamp = format(random.getrandbits(32), '08x')
 
-        # Establish a session with the Perplexity Labs API
-        self.sid = json.loads(self.session.get(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}').text[1:])['sid']
-        self.last_answer = None  # Store the last response from the API
-        self.history = []  # Maintain a history of queries and responses
+        self.router = LabsRouter()  # Routes the answers to the queries running over the WebSocket
+        self.router_lock = Lock()  # Guards the router, shared by the WebSocket thread and the asking threads
+        self.history = history if history is not None else History()  # Maintain a history of queries and responses
+        self.timeouts = timeouts or Timeouts()  # Deadlines used by queries that do not set their own
+
+        # The connection is set up on the first query or by warmup(), not in the constructor
+        self.ws = None
+        self.connect_lock = Lock()
+        self.closed = False
 
-        # Authenticate the session
-        assert self.session.post(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}&sid={self.sid}', data='40{"jwt":"anonymous-ask-user"}').text == 'OK'
+        # Seconds without any message after which the connection is considered dead, from the engine.io handshake
+        self.ping_timeout = None
+        self.last_message = None
 
-        # Set up a secure WebSocket connection
-        context = ssl.create_default_context()
-        context.minimum_version = ssl.TLSVersion.TLSv1_3
-        self.sock = context.wrap_socket(socket.create_connection(('www.perplexity.ai', 443)), server_hostname='www.perplexity.ai')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the WebSocket, which ends its thread, and the HTTP session.
+        Queries still waiting for an answer raise ConnectionError.
+        '''
+        self.closed = True
+
+        # Wake up the queries waiting for an answer
+        self._end_queries()
+
+        with self.connect_lock:
+            if self.ws is not None:
+                self.ws.close()
+
+        self.session.close()
+
+    def warmup(self, background=False):
+        '''
+        Sets up the Labs connection if that has not happened yet.
+
+        Parameters:
+        - background: Connect on a daemon thread and return immediately, so several clients can
+          be warmed up in parallel. A query sent meanwhile waits for the connection.
+
+        Returns:
+        - The client itself.
+        '''
+        if self.closed:
+            raise ConnectionError('The Labs client is closed.')
+
+        if self.ws is not None:
+            return self
+
+        if background:
+            Thread(target=self.warmup, daemon=True).start()
+            return self
+
+        with self.connect_lock:
+            if self.ws is None:
+                self._connect()
+
+        return self
+
+    def _connect(self):
+        '''
+        Opens the socket.io session and its WebSocket, raising ConnectTimeout after timeouts.connect seconds.
+        '''
+        timeout = self.timeouts.connect
+        start = time.monotonic()
+
+        try:
+            # The TLS connection of the WebSocket is opened while the session is negotiated over HTTP
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                sock = executor.submit(open_socket, timeout)
+
+                try:
+                    # Establish a session with the Perplexity Labs API
+                    handshake = codec.loads(self.session.get(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}', timeout=timeout).text[1:])
+                    self.sid = handshake['sid']
+
+                    # The server pings every pingInterval and drops clients that do not answer within pingTimeout
+                    self.ping_timeout = (handshake.get('pingInterval', 25000) + handshake.get('pingTimeout', 20000)) / 1000
+
+                    # Authenticate the session
+                    assert self.session.post(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}&sid={self.sid}', data='40{"jwt":"anonymous-ask-user"}', timeout=timeout).text == 'OK'
+                except BaseException:
+                    # The TLS connection will not be used, it is closed as soon as it is open
+                    sock.add_done_callback(lambda future: future.exception() or future.result().close())
+                    raise
+
+                self.sock = sock.result()
+        except (CurlTimeout, socket.timeout) as e:
+            raise ConnectTimeout(timeout) from e
 
         # Initialize WebSocket client
-        self.ws = WebSocketApp(
+        opened = Event()
+        ws = WebSocketApp(
             url=f'wss://www.perplexity.ai/socket.io/?EIO=4&transport=websocket&sid={self.sid}',
             header={'User-Agent': self.session.headers['User-Agent']},
             cookie='; '.join([f'{key}={value}' for key, value in self.session.cookies.get_dict().items()]),
-            on_open=lambda ws: (ws.send('2probe'), ws.send('5')),
+            on_open=lambda ws: (ws.send('2probe'), ws.send('5'), opened.set()),
             on_message=self._on_message,
             on_error=lambda ws, error: print(f'Websocket Error: {error}'),
+            on_close=lambda ws, *args: self._end_queries(),
             socket=self.sock
         )
 
         # Run the WebSocket client in a separate thread
-        Thread(target=self.ws.run_forever, daemon=True).start()
+        Thread(target=ws.run_forever, daemon=True).start()
 
         # Wait until the WebSocket connection is established
-        while not (self.ws.sock and self.ws.sock.connected):
-            time.sleep(0.01)
+        if not opened.wait(None if timeout is None else max(0, start + timeout - time.monotonic())):
+            ws.close()
+
+            # The WebSocket may not have taken over the socket yet
+            self.sock.close()
+            raise ConnectTimeout(timeout)
+
+        self.last_message = time.monotonic()
+        self.ws = ws
+
+    @property
+    def alive(self):
+        '''
+        Whether the WebSocket is open and the server pinged it recently enough for a query sent now to be answered.
+        A client with a query that passed its deadline without a final answer is not alive either.
+        '''
+        if self.closed or self.ws is None or not (self.ws.sock and self.ws.sock.connected):
+            return False
+
+        with self.router_lock:
+            if self.router.stuck():
+                return False
+
+        return time.monotonic() - self.last_message < self.ping_timeout
 
     def _on_message(self, ws, message):
         '''
         WebSocket message handler.
         '''
+        self.last_message = time.monotonic()
+
         if message == '2':
             ws.send('3')  # Respond to ping messages
 
         if message.startswith('42'):
-            response = json.loads(message[2:])[1]
+            event, response = codec.loads(message[2:])[:2]
 
             if 'final' in response:
-                self.last_answer = response
+                with self.router_lock:
+                    request = self.router.route(event, response)
+
+                # The next query of the same model is sent once this answer is final
+                if request is not None:
+                    self._submit(request)
+
+    def _end_queries(self):
+        '''
+        Fails the queries still waiting for an answer, once the WebSocket is closed.
+        '''
+        with self.router_lock:
+            self.router.close()
+
+    def _send(self, request):
+        '''
+        Sends a query via WebSocket.
+        '''
+        # The conversation is already encoded, so only the model is serialized here
+        self.ws.send(f'42["perplexity_labs",{{"messages":{request.messages},"model":{codec.dumps(request.model)},"source":"default","version":"2.18"}}]')
 
-    def ask(self, query, model='r1-1776', stream=False):
+    def _submit(self, request):
+        '''
+        Sends a query, withdrawing it from the router when the WebSocket fails so the queries after it still run.
+        '''
+        while request is not None:
+            try:
+                self._send(request)
+                return
+            except Exception as e:
+                with self.router_lock:
+                    failed, request = request, self.router.withdraw(request)
+
+                failed.answers.put_nowait(e)
+
+    def _answers(self, request):
+        '''
+        Generator of the answers of a query, up to the final one, which is recorded in the history.
+
+        Raises the timeout of the current phase once its deadline passes, or ConnectionError when the client is closed.
+        The deadline starts when the query is sent, not while it waits behind a query of the same model.
+        '''
+        try:
+            while True:
+                with self.router_lock:
+                    deadline = request.deadline
+                    remaining, error = deadline.remaining() if deadline is not None else (self.router.wait_time(request), None)
+
+                if deadline is not None and remaining is not None and remaining <= 0:
+                    raise error
+
+                try:
+                    answer = request.answers.get(timeout=remaining)
+                except Empty:
+                    # The query in flight ahead of this one passed its deadline, its lane is freed
+                    if deadline is None:
+                        self._expire()
+
+                    continue
+
+                if answer is SENT:
+                    continue
+
+                if answer is CLOSED:
+                    raise ConnectionError('The Labs client was closed before the answer arrived.')
+
+                # The query could not be sent
+                if isinstance(answer, Exception):
+                    raise answer
+
+                if answer.get('final'):
+                    self.history.extend((request.message, {'role': 'assistant', 'content': answer['output'], 'priority': 0}))
+                    yield answer
+                    return
+
+                yield answer
+        finally:
+            # A query given up early stops receiving answers, one that timed out frees its lane
+            with self.router_lock:
+                send = self.router.abandon(request)
+
+            if send is not None:
+                self._submit(send)
+
+    def _expire(self):
+        '''
+        Sends the queries waiting behind queries that passed their deadline.
+        '''
+        with self.router_lock:
+            requests = self.router.expire()
+
+        for request in requests:
+            self._submit(request)
+
+    def ask(self, query, model='r1-1776', stream=False, timeouts=None, delta=False):
         '''
         Sends a query to the Perplexity Labs API.
 
+        Queries can be sent from several threads over the same WebSocket. Those of different
+        models run at the same time, those of the same model are sent one after the other.
+
         Parameters:
         - query: The query string.
         - model: The model to use for the query.
         - stream: Whether to stream the response.
+        - timeouts: Timeouts of this query, defaults to the ones of the client. Exceeding one raises
+          ConnectTimeout, FirstEventTimeout, IdleTimeout or TotalTimeout (all SearchTimeout subclasses).
+        - delta: When streaming, yield only the newly appended output and the fields that changed
+          instead of the whole answer every time, see perplexity.delta.LabsDeltaTracker.
 
         Returns:
         - The final response or a generator for streaming responses.
         '''
         assert model in ['r1-1776', 'sonar-pro', 'sonar', 'sonar-reasoning-pro', 'sonar-reasoning'], 'Invalid model.'
 
-        self.last_answer = None
-        self.history.append({'role': 'user', 'content': query})
-
-        # Send the query via WebSocket
-        self.ws.send('42' + json.dumps([
-            'perplexity_labs',
-            {
-                'messages': self.history,
-                'model': model,
-                'source': 'default',
-                'version': '2.18',
-            }
-        ]))
-
-        def stream_response():
-            '''
-            Generator for streaming responses.
-            '''
-            answer = None
+        self.warmup()
 
-            while True:
-                if self.last_answer != answer:
-                    answer = self.last_answer
-                    yield answer
+        # The history is only extended once the answer is final, so concurrent queries do not interleave their turns
+        message = {'role': 'user', 'content': query}
+        request = LabsRequest(model, message, self.history.encode(message), SimpleQueue(), timeouts or self.timeouts)
 
-                if self.last_answer and self.last_answer.get('final'):
-                    answer = self.last_answer
-                    self.last_answer = None
-                    self.history.append({'role': 'assistant', 'content': answer['output'], 'priority': 0})
+        with self.router_lock:
+            if self.closed:
+                raise ConnectionError('The Labs client is closed.')
 
-                    return
+            send = self.router.submit(request)
 
-                time.sleep(0.01)
+        if send is not None:
+            self._submit(send)
 
         if stream:
-            return stream_response()
-
-        while True:
-            if self.last_answer and self.last_answer.get('final'):
-                answer = self.last_answer
-                self.last_answer = None
-                self.history.append({'role': 'assistant', 'content': answer['output'], 'priority': 0})
+            return iter_deltas(self._answers(request), LabsDeltaTracker()) if delta else self._answers(request)
 
+        for answer in self._answers(request):
+            if answer.get('final'):
                 return answer
-
-            time.sleep(0.01)
\ No newline at end of file
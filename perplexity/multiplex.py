@@ -0,0 +1,228 @@
+# Importing necessary modules
+# collections: Queues of the asks waiting on each model
+# timeouts: Deadlines of the asks, started once they are sent
+from collections import deque
+
+from .timeouts import Deadline
+
+# Suffix of the socket.io events carrying the answers of a model ('r1-1776_query_progress')
+EVENT_SUFFIX = '_query_progress'
+
+# Put in the answer queue of an ask when the connection ends before its final answer
+CLOSED = object()
+
+# Put in the answer queue of a queued ask once the ask before it is done and it is sent
+SENT = object()
+
+
+class LabsRequest:
+    '''
+    One ask sent over a Labs websocket.
+
+    Attributes:
+    - model: The model of the ask.
+    - message: The user message of the ask, added to the history with the final answer.
+    - messages: The JSON array of the conversation sent with the ask, see perplexity.history.History.encode.
+    - answers: Queue the answers are put in, queue.SimpleQueue for the sync client and
+      asyncio.Queue for the async one. CLOSED is put in it when the connection ends, SENT when
+      a queued ask is sent, the exception raised by the WebSocket when the ask could not be sent.
+    - timeouts: The Timeouts of the ask.
+    - deadline: The Deadline of the ask, None while it waits for its lane. Time spent queued
+      behind another ask of the same model does not count against it.
+    - abandoned: Whether the caller stopped waiting, its answers are then dropped.
+    '''
+
+    __slots__ = ('model', 'message', 'messages', 'answers', 'timeouts', 'deadline', 'abandoned')
+
+    def __init__(self, model, message, messages, answers, timeouts):
+        self.model = model
+        self.message = message
+        self.messages = messages
+        self.answers = answers
+        self.timeouts = timeouts
+        self.deadline = None
+        self.abandoned = False
+
+    def expired(self):
+        '''
+        Whether the ask was sent and passed its deadline.
+        '''
+        if self.deadline is None:
+            return False
+
+        remaining, _ = self.deadline.remaining()
+
+        return remaining is not None and remaining <= 0
+
+
+class LabsRouter:
+    '''
+    Routes the answers arriving on one Labs websocket to the asks they belong to.
+
+    The server names the events of an answer after its model and echoes no request id, so
+    asks of different models run at the same time while asks of the same model are queued
+    in a lane and sent one after the other, as soon as the previous answer is final or the
+    previous ask passed its deadline. The router does no I/O: its methods return the requests
+    to send next, if any.
+    '''
+
+    def __init__(self):
+        self.lanes = {}  # Model -> deque of LabsRequest, the first one is in flight
+        self.stalled = False  # Whether a query in flight passed its deadline without a final answer
+
+    def submit(self, request):
+        '''
+        Adds an ask, returns it when it can be sent right away or None when it waits for its lane.
+        '''
+        lane = self.lanes.setdefault(request.model, deque())
+        lane.append(request)
+
+        if len(lane) > 1:
+            return None
+
+        request.deadline = Deadline(request.timeouts)
+
+        return request
+
+    def route(self, event, response):
+        '''
+        Delivers an answer to its ask.
+
+        Returns:
+        - The queued request to send now that the lane is free, or None.
+        '''
+        model = event[:-len(EVENT_SUFFIX)] if event.endswith(EVENT_SUFFIX) else None
+        lane = self.lanes.get(model)
+
+        # Events named differently go to the only ask in flight, if there is just one
+        if lane is None:
+            if len(self.lanes) != 1:
+                return None
+
+            model, lane = next(iter(self.lanes.items()))
+
+        request = lane[0]
+
+        # Every answer counts as an event for the idle timeout, even once the caller stopped waiting
+        request.deadline.event()
+
+        if not request.abandoned:
+            request.answers.put_nowait(response)
+
+        if not response.get('final'):
+            return None
+
+        return self._next(model, lane)
+
+    def abandon(self, request):
+        '''
+        Withdraws an ask whose caller stopped waiting.
+
+        An ask that was not sent yet leaves its lane. One in flight keeps it until its final
+        answer arrives, so the answers of the next ask are not mixed with its own, or until
+        it passes its deadline.
+
+        Returns:
+        - The queued request to send now that the lane is free, or None.
+        '''
+        lane = self.lanes.get(request.model)
+
+        if lane is None or request not in lane:
+            return None
+
+        if lane[0] is not request:
+            lane.remove(request)
+            return None
+
+        request.abandoned = True
+
+        if not request.expired():
+            return None
+
+        self.stalled = True
+
+        return self._next(request.model, lane)
+
+    def expire(self):
+        '''
+        Frees the lanes whose ask in flight passed its deadline, so the asks queued behind it
+        are sent instead of waiting for a final answer that may never come.
+
+        Returns:
+        - The list of queued requests to send.
+        '''
+        requests = []
+
+        for model, lane in list(self.lanes.items()):
+            if lane[0].expired():
+                self.stalled = True
+                request = self._next(model, lane)
+
+                if request is not None:
+                    requests.append(request)
+
+        return requests
+
+    def stuck(self):
+        '''
+        Whether a query in flight passed its deadline without a final answer, now or earlier.
+        The connection may then no longer answer its model.
+        '''
+        return self.stalled or any(lane[0].expired() for lane in self.lanes.values())
+
+    def wait_time(self, request):
+        '''
+        Seconds until the ask in flight ahead of a queued request passes its deadline, after
+        which expire() frees the lane. None when there is no such deadline.
+        '''
+        lane = self.lanes.get(request.model)
+
+        if not lane or lane[0] is request:
+            return None
+
+        remaining, _ = lane[0].deadline.remaining()
+
+        return remaining
+
+    def withdraw(self, request):
+        '''
+        Removes an ask that could not be sent.
+
+        Returns:
+        - The queued request to send in its place, or None.
+        '''
+        lane = self.lanes.get(request.model)
+
+        if lane is None or request not in lane:
+            return None
+
+        if lane[0] is request:
+            return self._next(request.model, lane)
+
+        lane.remove(request)
+
+        return None
+
+    def close(self):
+        '''
+        Ends every ask with CLOSED, once the connection is gone.
+        '''
+        lanes, self.lanes = self.lanes, {}
+
+        for lane in lanes.values():
+            for request in lane:
+                request.answers.put_nowait(CLOSED)
+
+    def _next(self, model, lane):
+        lane.popleft()
+
+        if not lane:
+            del self.lanes[model]
+            return None
+
+        # The deadline of the next ask starts now that it is sent
+        request = lane[0]
+        request.deadline = Deadline(request.timeouts)
+        request.answers.put_nowait(SENT)
+
+        return request
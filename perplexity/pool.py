@@ -0,0 +1,216 @@
+# Importing necessary modules
+# threading: Guarding the idle clients and running the health checks
+# collections: Queue of the idle clients
+# contextlib: Leases as context managers
+# concurrent.futures: Bounded number of connections set up at the same time
+# labs: The pooled Labs clients
+from threading import Condition, Event, Thread
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .labs import LabsClient
+
+
+class LabsClientPool:
+    '''
+    A pool of connected LabsClient sessions leased to callers.
+
+    The pool keeps size clients connected. Their WebSocket threads answer the engine.io pings
+    while they are idle, so a leased client sends its query right away instead of going through
+    the polling, authentication and WebSocket handshakes first. Dead clients, and clients with
+    a query that passed its deadline without a final answer, are found by a health check every
+    check_interval seconds, or when they are given back, and replaced in the background. At
+    most connect_concurrency handshakes run at the same time and failed ones are retried with
+    an exponential backoff, so bursts of queries or outages never stampede the handshake
+    endpoint.
+    '''
+
+    def __init__(self, size=4, timeouts=None, check_interval=5, connect_concurrency=2, backoff=1, max_backoff=30):
+        '''
+        Parameters:
+        - size: Number of clients kept connected.
+        - timeouts: Timeouts of the clients, see LabsClient.
+        - check_interval: Seconds between two health checks of the idle clients.
+        - connect_concurrency: Maximum number of clients connecting at the same time.
+        - backoff: Seconds waited after a failed connection, doubled after every further failure.
+        - max_backoff: Upper bound of the wait after a failed connection.
+        '''
+        assert size > 0, 'size must be positive.'
+        assert connect_concurrency > 0, 'connect_concurrency must be positive.'
+
+        self.size = size
+        self.timeouts = timeouts
+        self.check_interval = check_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.idle = deque()  # Connected clients waiting for a lease
+        self.leased = set()
+        self.available = Condition()  # Notified when a client becomes idle or the pool is closed
+        self.closed = False
+        self.stopped = Event()  # Ends the health checks and the backoff waits
+
+        self.connector = ThreadPoolExecutor(max_workers=connect_concurrency, thread_name_prefix='perplexity-labs-pool')
+
+        # The clients are connected in the background, a lease waits for the first one
+        for _ in range(size):
+            self.connector.submit(self._connect)
+
+        Thread(target=self._check, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes every client of the pool, leased ones included. Waiting leases raise ConnectionError.
+        '''
+        with self.available:
+            self.closed = True
+            clients = list(self.idle) + list(self.leased)
+            self.idle.clear()
+            self.leased.clear()
+            self.available.notify_all()
+
+        self.stopped.set()
+        self.connector.shutdown(wait=False, cancel_futures=True)
+
+        for client in clients:
+            client.close()
+
+    def _connect(self):
+        '''
+        Connects a new client and makes it idle, retrying with backoff until it succeeds or the pool is closed.
+        '''
+        delay = self.backoff
+
+        while not self.closed:
+            client = LabsClient(self.timeouts)
+
+            try:
+                client.warmup()
+            except Exception:
+                client.close()
+
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+                continue
+
+            with self.available:
+                if not self.closed:
+                    self.idle.append(client)
+                    self.available.notify()
+                    return
+
+            client.close()
+            return
+
+    def _replace(self, client):
+        '''
+        Closes a dead client and connects another one in its place.
+        '''
+        client.close()
+
+        try:
+            self.connector.submit(self._connect)
+        except RuntimeError:
+            pass  # The pool was closed meanwhile
+
+    def _check(self):
+        '''
+        Replaces the idle clients that are no longer alive, every check_interval seconds.
+        '''
+        while not self.stopped.wait(self.check_interval):
+            with self.available:
+                dead = [client for client in self.idle if not client.alive]
+
+                for client in dead:
+                    self.idle.remove(client)
+
+            for client in dead:
+                self._replace(client)
+
+    def acquire(self, timeout=None):
+        '''
+        Takes a connected client out of the pool.
+
+        Parameters:
+        - timeout: Seconds to wait for an idle client, None to wait until one is available.
+
+        Raises TimeoutError when no client became idle in time, ConnectionError when the pool is closed.
+        '''
+        while True:
+            with self.available:
+                if not self.available.wait_for(lambda: self.idle or self.closed, timeout):
+                    raise TimeoutError(f'No Labs client became available within {timeout} seconds.')
+
+                if self.closed:
+                    raise ConnectionError('The Labs client pool is closed.')
+
+                client = self.idle.popleft()
+
+                if client.alive:
+                    self.leased.add(client)
+                    return client
+
+            # A client that died since the last health check is replaced and the next one is tried
+            self._replace(client)
+
+    def release(self, client):
+        '''
+        Gives a client back to the pool, one that is no longer alive is replaced.
+        Its history is cleared, so conversations are not carried over to the next caller.
+        '''
+        client.history.clear()
+
+        with self.available:
+            self.leased.discard(client)
+
+            if client.alive and not self.closed:
+                self.idle.append(client)
+                self.available.notify()
+                return
+
+        self._replace(client)
+
+    @contextmanager
+    def lease(self, timeout=None):
+        '''
+        Context manager leasing a connected client, given back to the pool on exit. See acquire() for timeout.
+        '''
+        client = self.acquire(timeout)
+
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def ask(self, query, model='r1-1776', stream=False, timeouts=None, lease_timeout=None, delta=False):
+        '''
+        Sends a query on a leased client, see LabsClient.ask. A stream keeps its client until it is exhausted or closed.
+
+        Parameters:
+        - lease_timeout: Seconds to wait for an idle client, see acquire().
+        '''
+        if not stream:
+            with self.lease(lease_timeout) as client:
+                return client.ask(query, model=model, timeouts=timeouts)
+
+        def stream_response():
+            with self.lease(lease_timeout) as client:
+                yield from client.ask(query, model=model, stream=True, timeouts=timeouts, delta=delta)
+
+        return stream_response()
+
+    @property
+    def stats(self):
+        '''
+        Dictionary with the number of idle and leased clients.
+        '''
+        with self.available:
+            return {'idle': len(self.idle), 'leased': len(self.leased)}
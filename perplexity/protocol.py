@@ -0,0 +1,312 @@
+# Importing necessary modules
+# re: Regular expressions for pattern matching
+# json: Decode error type shared by all codecs
+# mimetypes: Guessing MIME types of files
+# uuid: Generating unique identifiers
+# curl_cffi: Multipart form data handling
+# sse: Incremental parsing of the server-sent event stream
+# frame: Lazily decoded stream frames and typed search results
+# steps: Index of the latest step of each type
+# uploads: Attachment upload helpers
+import re
+import json
+import mimetypes
+from uuid import uuid4
+from curl_cffi import CurlMime
+
+from . import sse
+from .frame import Frame, SearchResult
+from .steps import StepIndex
+from .uploads import file_part
+
+# The protocol core builds the requests of a search and consumes the bytes of its response.
+# It does no I/O, perplexity.Client and perplexity_async.Client send what it builds.
+
+# Endpoints of the Perplexity web API
+SESSION_URL = 'https://www.perplexity.ai/api/auth/session'
+SIGNIN_URL = 'https://www.perplexity.ai/api/auth/signin/email'
+UPLOAD_URL = 'https://www.perplexity.ai/rest/uploads/create_upload_url?version=2.18&source=default'
+SEARCH_URL = 'https://www.perplexity.ai/rest/sse/perplexity_ask'
+
+# Default headers of the client sessions, those of Chrome 128 on Windows
+HEADERS = {
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'accept-language': 'en-US,en;q=0.9',
+    'cache-control': 'max-age=0',
+    'dnt': '1',
+    'priority': 'u=0, i',
+    'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
+    'sec-ch-ua-arch': '"x86"',
+    'sec-ch-ua-bitness': '"64"',
+    'sec-ch-ua-full-version': '"128.0.6613.120"',
+    'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-model': '""',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-ch-ua-platform-version': '"19.0.0"',
+    'sec-fetch-dest': 'document',
+    'sec-fetch-mode': 'navigate',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-user': '?1',
+    'upgrade-insecure-requests': '1',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
+}
+
+# Regular expression for extracting sign-in links
+SIGNIN_REGEX = re.compile(r'"(https://www\.perplexity\.ai/api/auth/callback/email\?callbackUrl=.*?)"')
+
+# Model preference sent for each model of each search mode
+MODEL_PREFERENCES = {
+    'auto': { None: 'turbo' },
+    'pro': {
+        None: 'pplx_pro',
+        'sonar': 'experimental',
+        'gpt-4.5': 'gpt45',
+        'gpt-4o': 'gpt4o',
+        'claude 3.7 sonnet': 'claude2',
+        'gemini 2.0 flash': 'gemini2flash',
+        'grok-2': 'grok'
+    },
+    'reasoning': {
+        None: 'pplx_reasoning',
+        'r1': 'r1',
+        'o3-mini': 'o3mini',
+        'claude 3.7 sonnet': 'claude37sonnetthinking'
+    },
+    'deep research': { None: 'pplx_alpha' }
+}
+
+# Search modes, those that use a pro query, and search sources
+MODES = tuple(MODEL_PREFERENCES)
+PRO_MODES = ('pro', 'reasoning', 'deep research')
+SOURCES = ('web', 'scholar', 'social')
+
+
+# Assertion messages of the sync client, file_upload is formatted with the number of files and remaining uploads
+MESSAGES = {
+    'mode': 'Invalid search mode.',
+    'model': 'Invalid model for the selected mode.',
+    'sources': 'Invalid sources.',
+    'copilot': 'No remaining pro queries.',
+    'file_upload': 'File upload limit exceeded.',
+}
+
+# Assertion messages of the async client
+ASYNC_MESSAGES = {
+    'mode': 'Search modes -> ["auto", "pro", "reasoning", "deep research"]',
+    'model': '''Models for modes -> {
+    'auto': [None],
+    'pro': [None, 'sonar', 'gpt-4.5', 'gpt-4o', 'claude 3.7 sonnet', 'gemini 2.0 flash', 'grok-2'],
+    'reasoning': [None, 'r1', 'o3-mini', 'claude 3.7 sonnet'],
+    'deep research': [None]
+}''',
+    'sources': 'Sources -> ["web", "scholar", "social"]',
+    'copilot': 'You have used all of your enhanced (pro) queries',
+    'file_upload': 'You have tried to upload {files} files but you have {remaining} file upload(s) remaining.',
+}
+
+
+def check_search(mode, model, sources, own, messages=MESSAGES):
+    '''
+    Validates the arguments of a search, models can only be chosen with an own account.
+    '''
+    assert mode in MODES, messages['mode']
+    assert model in MODEL_PREFERENCES[mode] if own else True, messages['model']
+    assert all(source in SOURCES for source in sources), messages['sources']
+
+
+def charge_search(mode, files, copilot, file_upload, messages=MESSAGES):
+    '''
+    Checks that a search fits in the remaining pro queries and file uploads.
+
+    Returns:
+    - The tuple (copilot, file_upload) of what remains once the search is sent.
+    '''
+    assert copilot > 0 if mode in PRO_MODES else True, messages['copilot']
+    assert file_upload - len(files) >= 0 if files else True, messages['file_upload'].format(files=len(files), remaining=file_upload)
+
+    return copilot - 1 if mode in PRO_MODES else copilot, file_upload - len(files)
+
+
+def search_payload(query, mode, model, sources, attachments, language, follow_up, incognito):
+    '''
+    Builds the JSON payload of a search request.
+    '''
+    return {
+        'query_str': query,
+        'params': {
+            'attachments': attachments + follow_up['attachments'] if follow_up else attachments,
+            'frontend_context_uuid': str(uuid4()),
+            'frontend_uuid': str(uuid4()),
+            'is_incognito': incognito,
+            'language': language,
+            'last_backend_uuid': follow_up['backend_uuid'] if follow_up else None,
+            'mode': 'concise' if mode == 'auto' else 'copilot',
+            'model_preference': MODEL_PREFERENCES[mode][model],
+            'source': 'default',
+            'sources': sources,
+            'version': '2.18'
+        }
+    }
+
+
+def attempt_payload(json_data):
+    '''
+    Returns the payload of one attempt of a search, every attempt is a new request for the
+    server, retried or hedged ones included.
+    '''
+    return dict(json_data, params=dict(json_data['params'], frontend_uuid=str(uuid4())))
+
+
+def upload_part(filename, file):
+    '''
+    Prepares a file of a search for upload.
+
+    Returns:
+    - A tuple (file_type, file_size, part), see perplexity.uploads.file_part for part, which is
+      given to perplexity.uploads.release_part once the upload is over.
+    '''
+    file_size, part = file_part(file)
+
+    return mimetypes.guess_type(filename)[0], file_size, part
+
+
+def upload_url_payload(filename, file_type, file_size):
+    '''
+    Builds the JSON payload asking for the upload URL of a file.
+    '''
+    return {
+        'content_type': file_type,
+        'file_size': file_size,
+        'filename': filename,
+        'force_image': False,
+        'source': 'default',
+    }
+
+
+def upload_multipart(file_upload_info, filename, file_type, part):
+    '''
+    Builds the multipart form uploading a file to the URL returned for it.
+    '''
+    mp = CurlMime()
+    for key, value in file_upload_info['fields'].items():
+        mp.addpart(name=key, data=value)
+    mp.addpart(name='file', content_type=file_type, filename=filename, **{key: value for key, value in part.items() if key != 'spooled'})
+
+    return mp
+
+
+def extract_answer(response_data):
+    '''
+    Extract the final answer text from Perplexity response data.
+    '''
+    if not response_data:
+        return None
+
+    # 尝试从不同字段提取答案
+    text_content = response_data.get('text', [])
+
+    # 查找包含答案的步骤 (frames carry their own step index, plain dictionaries are indexed here)
+    index = response_data.index if isinstance(response_data, Frame) else StepIndex(text_content)
+    answer = index.answer
+
+    if answer:
+        return answer
+
+    if isinstance(text_content, list):
+        # 如果没有找到特定的答案步骤，查找最后一个有内容的步骤
+        for step in reversed(text_content):
+            if isinstance(step, dict):
+                content = step.get('content', {})
+                if isinstance(content, dict) and 'text' in content:
+                    text = content['text']
+                    if text and len(text.strip()) > 10:  # 过滤掉太短的内容
+                        return text
+                elif isinstance(content, str) and len(content.strip()) > 10:
+                    return content
+
+    # 尝试其他可能的字段
+    for field in ['answer', 'response', 'result', 'output']:
+        if field in response_data:
+            value = response_data[field]
+            if isinstance(value, str) and value.strip():
+                return value
+
+    return None
+
+
+class SearchReader:
+    '''
+    Consumes the response of a search.
+
+    Raw bytes are given to feed(), or events already parsed by perplexity.sse to receive().
+    Both return the frames of the stream, done is set once nothing useful can follow, and
+    result() builds the SearchResult of a non-stream search. Intermediate frames are only
+    scanned for completion markers. Frames matching one are decoded, and the stream ends only
+    when their top-level status or final_sse_message confirms it, not on a nested step.
+    '''
+
+    __slots__ = ('parser', 'done', 'last_frame', 'final_frame')
+
+    def __init__(self):
+        self.parser = None  # Created by the first feed()
+        self.done = False
+        self.last_frame = None
+        self.final_frame = None  # Last frame that carried a completion marker
+
+    def receive(self, event):
+        '''
+        Consumes an SSEEvent, returns its Frame or None for other events.
+        '''
+        if self.done:
+            return None
+
+        if event.type == sse.END_OF_STREAM:
+            self.done = True
+
+        if event.type != sse.MESSAGE:
+            return None
+
+        frame = self.last_frame = Frame(event.data)
+
+        # 检查是否包含最终答案
+        if frame.is_completing:
+            self.final_frame = frame
+
+        # Nothing useful follows the final frame
+        if frame.is_final:
+            self.done = True
+
+        return frame
+
+    def feed(self, data):
+        '''
+        Consumes raw response bytes, b'' once the response has ended, and returns the completed frames.
+        '''
+        if self.parser is None:
+            self.parser = sse.SSEParser()
+
+        events = self.parser.feed(data) if data else self.parser.flush()
+
+        return [frame for frame in map(self.receive, events) if frame is not None]
+
+    def result(self):
+        '''
+        Returns the SearchResult built from the final frame, or from the last one when no frame completed the answer.
+        '''
+        # 返回最终答案，如果没有找到则返回最后一个chunk
+        result_frame = self.final_frame or self.last_frame
+
+        try:
+            # 尝试提取可读的答案文本
+            extracted_answer = extract_answer(result_frame) if result_frame else None
+        except json.JSONDecodeError:
+            result_frame = None
+
+        if not result_frame:
+            return SearchResult(None, 'no_response', None)
+
+        if extracted_answer:
+            return SearchResult(extracted_answer, 'success', result_frame)
+
+        return SearchResult(None, 'no_answer_extracted', result_frame)
@@ -0,0 +1,456 @@
+# Importing necessary modules
+# time: Backoff delays and first event latencies
+# random: Jitter of the backoff delays
+# asyncio: Racing the attempts of the async client
+# threading: Locking the counters shared by concurrent searches
+# collections: Window of recent first event latencies
+# concurrent.futures: Racing the attempts of the sync client
+# curl_cffi: Transport errors worth retrying
+# timeouts: Per-attempt deadlines
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from curl_cffi.requests.exceptions import ConnectionError as CurlConnectionError, CertificateVerifyError, HTTPError, ChunkedEncodingError
+
+from .timeouts import Deadline, ConnectTimeout
+
+# Interval at which requests waiting to be sent are checked for having started
+POLL_INTERVAL = 0.05
+
+# Failures that happen before the first event, so sending the search again is safe
+RETRYABLE_ERRORS = (CurlConnectionError, HTTPError, ChunkedEncodingError, ConnectTimeout)
+
+
+def retryable(error):
+    '''
+    Whether a search that failed with error before its first event may be sent again.
+    '''
+    return isinstance(error, RETRYABLE_ERRORS) and not isinstance(error, CertificateVerifyError)
+
+
+class Attempt:
+    '''
+    A search request whose stream was read up to its first event.
+
+    Attributes:
+    - resp: The streamed response.
+    - deadline: The Deadline of the request.
+    - first: The first event, or None when the stream ended without any.
+    - events: Iterator over the events that follow the first one.
+
+    Iterating an attempt yields every event of the stream, starting with the first one.
+    '''
+
+    __slots__ = ('resp', 'deadline', 'first', 'events')
+
+    def __init__(self, resp, deadline, first=None, events=None):
+        self.resp = resp
+        self.deadline = deadline
+        self.first = first
+        self.events = events
+
+    @property
+    def failed(self):
+        '''
+        Whether the server failed the request (5xx) or the stream ended without an event.
+        '''
+        return self.first is None or self.resp.status_code >= 500
+
+    @property
+    def retryable(self):
+        '''
+        Whether a failed request may be sent again: the server failed (5xx) or a successful (2xx)
+        response ended without an event. Client errors (4xx) would fail the same way again.
+        '''
+        status = self.resp.status_code
+
+        return status >= 500 or (self.first is None and 200 <= status < 300)
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+            yield from self.events
+
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+
+            async for event in self.events:
+                yield event
+
+
+class RetryStats:
+    '''
+    Counters of a RetryPolicy.
+
+    Attributes:
+    - requests: Number of searches run under the policy.
+    - attempts: Number of requests sent for them, retries and hedges included.
+    - retries: Number of searches sent again after a failure.
+    - hedges: Number of hedged duplicates sent.
+    - hedge_wins: Number of hedged duplicates that produced the first event before the original.
+    - budget_exhausted: Number of retries and hedges skipped because the budget was spent.
+    - failures: Number of searches that still failed after their retries.
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+        self.failures = 0
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return f'RetryStats({", ".join(f"{key}={value!r}" for key, value in self.to_dict().items())})'
+
+
+class RetryPolicy:
+    '''
+    Retries and hedging of the search requests of a client, up to their first event.
+
+    Once the first event has arrived the answer streams to the caller and is never sent again,
+    so only failures that happen before it are retried: connection errors, connect timeouts,
+    5xx responses and successful responses whose stream ends without any event. Other 4xx
+    responses are returned right away.
+
+    Parameters:
+    - attempts: Maximum number of times a search is sent, 1 disables retries.
+    - backoff: Delay before the first retry in seconds, doubled for each further retry.
+    - max_backoff: Upper bound of the backoff delay.
+    - jitter: Wait a random delay between 0 and the backoff delay ("full jitter"), so clients
+      that failed together do not retry together.
+    - budget: Retries and hedges allowed per search, on average. Every search adds budget
+      tokens to a bucket and every retry or hedge takes one, so a failing upstream is not
+      flooded with retries.
+    - burst: Size of the token bucket, which starts full.
+    - modes: Search modes whose failures are retried, None for all of them.
+    - hedge: Percentile (between 0 and 1) of the recent first event latencies after which a
+      duplicate request is sent, the first of both to produce an event is kept and the other
+      one is aborted. None disables hedging.
+    - hedge_delay: Delay in seconds used until hedge_samples latencies have been observed,
+      None to not hedge before that.
+    - hedge_samples: Number of recent latencies the percentile is computed from.
+    - hedge_modes: Search modes that are hedged. Only 'auto' by default, since a hedged pro
+      search is billed twice.
+    '''
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=8, jitter=True, budget=0.2, burst=10, modes=None, hedge=None, hedge_delay=None, hedge_samples=20, hedge_modes=('auto',)):
+        assert attempts > 0, 'attempts must be positive.'
+        assert hedge is None or 0 < hedge < 1, 'hedge must be a percentile between 0 and 1.'
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.burst = burst
+        self.modes = modes
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_samples = hedge_samples
+        self.hedge_modes = hedge_modes
+
+        self.stats = RetryStats()
+        self.tokens = burst
+        self.latencies = deque(maxlen=hedge_samples)
+        self._lock = threading.Lock()
+
+    def _begin(self):
+        with self._lock:
+            self.stats.requests += 1
+            self.tokens = min(self.burst, self.tokens + self.budget)
+
+    def _withdraw(self):
+        # Takes a token for a retry or a hedge
+        with self._lock:
+            if self.tokens < 1:
+                self.stats.budget_exhausted += 1
+                return False
+
+            self.tokens -= 1
+            return True
+
+    def _launched(self, hedge=False):
+        with self._lock:
+            self.stats.attempts += 1
+            self.stats.hedges += 1 if hedge else 0
+
+    def _won(self, deadline, hedge):
+        with self._lock:
+            self.latencies.append(deadline.last_event - deadline.start)
+            self.stats.hedge_wins += 1 if hedge else 0
+
+    def _hedge_at(self, mode, start):
+        '''
+        Returns the monotonic time at which a search sent at start is hedged, or None.
+        '''
+        if self.hedge is None or (self.hedge_modes is not None and mode not in self.hedge_modes):
+            return None
+
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+        if len(latencies) < self.hedge_samples:
+            return None if self.hedge_delay is None else start + self.hedge_delay
+
+        return start + latencies[int(self.hedge * (len(latencies) - 1))]
+
+    def _retry_delay(self, mode, attempt, result, error, deadline):
+        '''
+        Returns the delay before sending a failed search again, or None to give up.
+        '''
+        if attempt >= self.attempts or (self.modes is not None and mode not in self.modes):
+            return None
+
+        if result is not None and not result.retryable:
+            return None
+
+        if error is not None and not retryable(error):
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay = random.uniform(0, delay) if self.jitter else delay
+
+        # No retry that would start after the total deadline
+        remaining, _ = deadline.remaining()
+        if deadline.timeouts.total is not None and remaining is not None and delay >= remaining:
+            return None
+
+        return delay if self._withdraw() else None
+
+    def _failed(self):
+        with self._lock:
+            self.stats.failures += 1
+
+    def run(self, mode, submit, timeouts, abort):
+        '''
+        Sends a search of the sync client under the policy.
+
+        Parameters:
+        - mode: The search mode.
+        - submit: Function taking a Deadline, which starts one request and returns a Future
+          resolving to its Attempt. The Deadline is not started, the worker calls its begin()
+          when it sends the request.
+        - timeouts: The Timeouts of the search.
+        - abort: Function aborting the response of an attempt that is not used.
+
+        Returns:
+        - The Attempt that produced the first event, or the last failed one.
+        '''
+        self._begin()
+        origin = time.monotonic()
+        attempt = 1
+
+        while True:
+            result, error, deadline = self._race(mode, submit, timeouts, origin, abort)
+
+            if result is not None and not result.failed:
+                return result
+
+            delay = self._retry_delay(mode, attempt, result, error, deadline)
+
+            if delay is None:
+                self._failed()
+
+                if result is None:
+                    raise error
+
+                return result
+
+            if result is not None:
+                abort(result.resp)
+
+            with self._lock:
+                self.stats.retries += 1
+
+            attempt += 1
+            time.sleep(delay)
+
+    def _race(self, mode, submit, timeouts, origin, abort):
+        # Sends one request, and a hedged duplicate if it is slow to produce its first event
+        pending = {}  # future -> (deadline, hedge)
+        result = error = deadline = None
+
+        def launch(hedge=False):
+            # The phase deadlines start once a worker sends the request, see submit
+            deadline = Deadline(timeouts, origin, started=False)
+            pending[submit(deadline)] = (deadline, hedge)
+            self._launched(hedge)
+
+            return deadline
+
+        def abandon(future):
+            # A request still waiting for a worker is never sent
+            if future.cancel():
+                return
+
+            # One being sent cannot be interrupted, its response is aborted once it arrives
+            future.add_done_callback(lambda future: abort(future.result().resp) if not future.cancelled() and future.exception() is None else None)
+
+        launch()
+        hedge_at = self._hedge_at(mode, time.monotonic())
+
+        try:
+            while pending:
+                now = time.monotonic()
+                waits = [remaining for remaining, _ in (deadline.remaining() for deadline, _ in pending.values()) if remaining is not None]
+
+                # The deadlines of requests that were not sent yet start later, so they are polled
+                if any(deadline.start is None for deadline, _ in pending.values()):
+                    waits.append(POLL_INTERVAL)
+
+                if hedge_at is not None:
+                    waits.append(max(0.0, hedge_at - now))
+
+                done, _ = wait(pending, timeout=min(waits) if waits else None, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    deadline, hedge = pending.pop(future)
+
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+
+                    attempt = future.result()
+
+                    if not attempt.failed:
+                        self._won(deadline, hedge)
+                        return attempt, None, deadline
+
+                    if result is not None:
+                        abort(result.resp)
+
+                    result = attempt
+
+                # Requests past one of their deadlines are given up
+                for future, (deadline, _) in list(pending.items()):
+                    remaining, timeout_error = deadline.remaining()
+
+                    if remaining is not None and remaining <= 0:
+                        del pending[future]
+                        abandon(future)
+                        error = timeout_error
+
+                if hedge_at is not None and time.monotonic() >= hedge_at and pending:
+                    hedge_at = None
+
+                    if self._withdraw():
+                        launch(hedge=True)
+
+            return result, error, deadline
+        finally:
+            # Losers and requests left behind by an exception are aborted
+            for future in pending:
+                abandon(future)
+
+    async def arun(self, mode, submit, timeouts, abort):
+        '''
+        Sends a search of the async client under the policy, see run.
+
+        submit returns a coroutine resolving to the Attempt and abort is a coroutine function.
+        '''
+        self._begin()
+        origin = time.monotonic()
+        attempt = 1
+
+        while True:
+            result, error, deadline = await self._arace(mode, submit, timeouts, origin, abort)
+
+            if result is not None and not result.failed:
+                return result
+
+            delay = self._retry_delay(mode, attempt, result, error, deadline)
+
+            if delay is None:
+                self._failed()
+
+                if result is None:
+                    raise error
+
+                return result
+
+            if result is not None:
+                await abort(result.resp)
+
+            with self._lock:
+                self.stats.retries += 1
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _arace(self, mode, submit, timeouts, origin, abort):
+        pending = {}  # task -> (deadline, hedge)
+        result = error = deadline = None
+
+        def launch(hedge=False):
+            deadline = Deadline(timeouts, origin, started=False)
+            pending[asyncio.ensure_future(submit(deadline))] = (deadline, hedge)
+            self._launched(hedge)
+
+            return deadline
+
+        launch()
+        hedge_at = self._hedge_at(mode, time.monotonic())
+
+        try:
+            while pending:
+                now = time.monotonic()
+                waits = [remaining for remaining, _ in (deadline.remaining() for deadline, _ in pending.values()) if remaining is not None]
+
+                # The deadlines of requests that were not sent yet start later, so they are polled
+                if any(deadline.start is None for deadline, _ in pending.values()):
+                    waits.append(POLL_INTERVAL)
+
+                if hedge_at is not None:
+                    waits.append(max(0.0, hedge_at - now))
+
+                done, _ = await asyncio.wait(pending, timeout=min(waits) if waits else None, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    deadline, hedge = pending.pop(task)
+
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+
+                    attempt = task.result()
+
+                    if not attempt.failed:
+                        self._won(deadline, hedge)
+                        return attempt, None, deadline
+
+                    if result is not None:
+                        await abort(result.resp)
+
+                    result = attempt
+
+                # Cancelling a request past one of its deadlines releases its response
+                for task, (deadline, _) in list(pending.items()):
+                    remaining, timeout_error = deadline.remaining()
+
+                    if remaining is not None and remaining <= 0:
+                        del pending[task]
+                        task.cancel()
+                        error = timeout_error
+
+                if hedge_at is not None and time.monotonic() >= hedge_at and pending:
+                    hedge_at = None
+
+                    if self._withdraw():
+                        launch(hedge=True)
+
+            return result, error, deadline
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await abort(task.result().resp)
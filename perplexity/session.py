@@ -0,0 +1,175 @@
+# Importing necessary modules
+# threading: Locking the counters shared by concurrent requests
+# curl_cffi: HTTP sessions and libcurl connection options
+import threading
+from curl_cffi import requests, AsyncCurl, CurlOpt, CurlMOpt, CurlInfo, CurlHttpVersion
+
+# Connection details collected for every response
+CURL_INFOS = [CurlInfo.NUM_CONNECTS, CurlInfo.NAMELOOKUP_TIME_T, CurlInfo.CONNECT_TIME_T, CurlInfo.APPCONNECT_TIME_T]
+
+
+class PoolLimits:
+    '''
+    Connection pool limits of a client session.
+
+    Parameters:
+    - max_clients: Maximum number of requests in flight at the same time on an async session,
+      and of sync searches waiting for their first event at the same time.
+    - max_connections: Maximum number of open connections, 0 for no limit.
+    - max_host_connections: Maximum number of connections to a single host, 0 for no limit.
+    - max_idle_connections: Number of idle keep-alive connections kept open for reuse, None for the libcurl default.
+    - max_concurrent_streams: Maximum number of HTTP/2 streams multiplexed over one connection.
+    - keepalive: Whether TCP keep-alive probes are sent on idle connections.
+
+    The async session runs every request through one libcurl multi handle, so all of them share
+    its connection cache and concurrent searches are multiplexed over the same HTTP/2 connection.
+    The sync session keeps one curl handle per thread. Sync streaming searches are aborted once
+    their final event arrives, which closes their connection, so they do not reuse connections;
+    only the other requests sent from the same thread can.
+    '''
+
+    def __init__(self, max_clients=10, max_connections=0, max_host_connections=0, max_idle_connections=None, max_concurrent_streams=100, keepalive=True):
+        assert max_clients > 0, 'max_clients must be positive.'
+
+        self.max_clients = max_clients
+        self.max_connections = max_connections
+        self.max_host_connections = max_host_connections
+        self.max_idle_connections = max_idle_connections
+        self.max_concurrent_streams = max_concurrent_streams
+        self.keepalive = keepalive
+
+    def curl_options(self):
+        '''
+        Options set on every request of the session.
+        '''
+        options = {CurlOpt.TCP_KEEPALIVE: 1 if self.keepalive else 0}
+
+        if self.max_idle_connections is not None:
+            options[CurlOpt.MAXCONNECTS] = self.max_idle_connections
+
+        return options
+
+    def multi_options(self):
+        '''
+        Options set on the multi handle of an async session.
+        '''
+        options = {
+            CurlMOpt.MAX_TOTAL_CONNECTIONS: self.max_connections,
+            CurlMOpt.MAX_HOST_CONNECTIONS: self.max_host_connections,
+            CurlMOpt.MAX_CONCURRENT_STREAMS: self.max_concurrent_streams,
+        }
+
+        if self.max_idle_connections is not None:
+            options[CurlMOpt.MAXCONNECTS] = self.max_idle_connections
+
+        return options
+
+
+class SessionStats:
+    '''
+    Connection reuse statistics of a session.
+
+    Attributes:
+    - requests: Number of requests sent.
+    - connections: Number of new connections opened for them.
+    - reused: Number of requests sent over an already open connection.
+    - http2: Number of requests sent over HTTP/2.
+    - handshake_time: Total time spent in TCP and TLS handshakes, in seconds. DNS resolution is not included.
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.http2 = 0
+        self.handshake_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, resp):
+        '''
+        Adds the connection details of a response.
+        '''
+        infos = resp.infos
+        connections = infos.get(CurlInfo.NUM_CONNECTS) or 0
+
+        # libcurl times are measured from the start of the request, so the name lookup is subtracted.
+        # Without TLS the handshakes end with the TCP connect.
+        handshake_end = infos.get(CurlInfo.APPCONNECT_TIME_T) or infos.get(CurlInfo.CONNECT_TIME_T) or 0
+        handshake_time = max(0, handshake_end - (infos.get(CurlInfo.NAMELOOKUP_TIME_T) or 0)) / 1e6 if handshake_end else 0.0
+
+        with self._lock:
+            self.requests += 1
+            self.connections += connections
+            self.reused += 0 if connections else 1
+            self.http2 += 1 if resp.http_version >= CurlHttpVersion.V2_0 else 0
+            self.handshake_time += handshake_time
+
+    @property
+    def reuse_ratio(self):
+        '''
+        The share of requests that did not open a new connection.
+        '''
+        return self.reused / self.requests if self.requests else 0.0
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'connections': self.connections,
+            'reused': self.reused,
+            'reuse_ratio': self.reuse_ratio,
+            'http2': self.http2,
+            'handshake_time': self.handshake_time,
+        }
+
+    def __repr__(self):
+        return f'SessionStats({", ".join(f"{key}={value!r}" for key, value in self.to_dict().items())})'
+
+
+class Session(requests.Session):
+    '''
+    A curl_cffi Session with configurable pool limits that records connection reuse in stats.
+    '''
+
+    def __init__(self, limits=None, **kwargs):
+        self.limits = limits or PoolLimits()
+        self.stats = SessionStats()
+
+        super().__init__(curl_options=self.limits.curl_options(), curl_infos=CURL_INFOS, **kwargs)
+
+    def request(self, *args, **kwargs):
+        resp = super().request(*args, **kwargs)
+        self.stats.record(resp)
+
+        return resp
+
+
+class AsyncSession(requests.AsyncSession):
+    '''
+    A curl_cffi AsyncSession with configurable pool limits that records connection reuse in stats.
+
+    The session can be shared by any number of concurrent searches, at most limits.max_clients
+    of them have a request in flight at the same time.
+    '''
+
+    def __init__(self, limits=None, **kwargs):
+        self.limits = limits or PoolLimits()
+        self.stats = SessionStats()
+
+        super().__init__(max_clients=self.limits.max_clients, curl_options=self.limits.curl_options(), curl_infos=CURL_INFOS, **kwargs)
+
+    @property
+    def acurl(self):
+        # The multi handle is created on first use, inside the running event loop
+        if self._acurl is None:
+            self._acurl = AsyncCurl(loop=self.loop)
+
+            for option, value in self.limits.multi_options().items():
+                self._acurl.setopt(option, value)
+
+        return self._acurl
+
+    async def request(self, *args, **kwargs):
+        resp = await super().request(*args, **kwargs)
+        self.stats.record(resp)
+
+        return resp
@@ -0,0 +1,179 @@
+# Importing necessary modules
+# codec: JSON parsing of event payloads
+from . import codec
+
+# Event types produced by the parser
+MESSAGE = 'message'
+END_OF_STREAM = 'end_of_stream'
+UNKNOWN = 'unknown'
+
+_KNOWN_EVENTS = {b'message': MESSAGE, b'end_of_stream': END_OF_STREAM}
+
+
+class SSEEvent:
+    '''
+    A single server-sent event.
+
+    Attributes:
+    - type: One of MESSAGE, END_OF_STREAM or UNKNOWN.
+    - event: The raw event name as sent by the server.
+    - data: The event payload as bytes, multi-line data fields joined with b'\\n'.
+    '''
+
+    __slots__ = ('type', 'event', 'data')
+
+    def __init__(self, type, event, data):
+        self.type = type
+        self.event = event
+        self.data = data
+
+    def json(self):
+        '''
+        Decodes the event payload as JSON.
+        '''
+        return codec.loads(self.data)
+
+    def __repr__(self):
+        return f'SSEEvent(type={self.type!r}, event={self.event!r}, data=<{len(self.data)} bytes>)'
+
+
+class SSEParser:
+    '''
+    An incremental parser for server-sent event streams.
+
+    Raw network chunks are appended to a reusable byte buffer and complete frames are
+    located by searching for the blank-line delimiter directly in bytes, so partial
+    frames are never decoded or re-joined. The stream may use either '\\r\\n\\r\\n' or
+    '\\n\\n' delimiters, and repeated 'data:' fields are joined as described by the SSE spec.
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.delimiter = None  # Locked to the first delimiter seen in the stream
+        self._scan_from = 0  # Offset before which no delimiter can start
+
+    def feed(self, data):
+        '''
+        Appends raw bytes to the buffer and returns the list of completed events.
+        '''
+        buffer = self.buffer
+        buffer.extend(data)
+
+        if self.delimiter is None and not self._detect_delimiter():
+            return []
+
+        delimiter = self.delimiter
+        events = []
+        start = 0
+        end = buffer.find(delimiter, self._scan_from)
+
+        while end != -1:
+            event = self._parse_frame(buffer, start, end)
+            if event is not None:
+                events.append(event)
+
+            start = end + len(delimiter)
+            end = buffer.find(delimiter, start)
+
+        if start:
+            del buffer[:start]
+
+        # A delimiter split across chunks can begin at most len(delimiter) - 1 bytes before the end
+        self._scan_from = max(0, len(buffer) - len(delimiter) + 1)
+
+        return events
+
+    def _detect_delimiter(self):
+        '''
+        Picks the frame delimiter from the first blank line in the buffer.
+        '''
+        crlf = self.buffer.find(b'\r\n\r\n', self._scan_from)
+        lf = self.buffer.find(b'\n\n', self._scan_from)
+
+        if crlf == -1 and lf == -1:
+            self._scan_from = max(0, len(self.buffer) - 3)
+            return False
+
+        self.delimiter = b'\r\n\r\n' if lf == -1 or (crlf != -1 and crlf < lf) else b'\n\n'
+        self._scan_from = 0
+
+        return True
+
+    def flush(self):
+        '''
+        Returns the event left in the buffer when the stream ends without a final delimiter.
+        '''
+        buffer = self.buffer
+        event = self._parse_frame(buffer, 0, len(buffer)) if buffer.strip() else None
+
+        buffer.clear()
+        self.delimiter = None
+        self._scan_from = 0
+
+        return [event] if event is not None else []
+
+    @staticmethod
+    def _parse_frame(buffer, start, end):
+        '''
+        Parses the fields of the frame stored in buffer[start:end].
+        '''
+        event = b'message'
+        data = []
+
+        pos = start
+        while pos < end:
+            eol = buffer.find(b'\n', pos, end)
+            if eol == -1:
+                eol = end
+            line_end = eol - 1 if eol > pos and buffer[eol - 1] == 0x0d else eol
+
+            if line_end > pos and buffer[pos] != 0x3a:  # Skip empty lines and ':' comments
+                colon = buffer.find(b':', pos, line_end)
+                if colon == -1:
+                    field, value_start = bytes(buffer[pos:line_end]), line_end
+                else:
+                    field, value_start = bytes(buffer[pos:colon]), colon + 1
+                    if value_start < line_end and buffer[value_start] == 0x20:
+                        value_start += 1
+
+                if field == b'data':
+                    data.append(bytes(buffer[value_start:line_end]))
+                elif field == b'event':
+                    event = bytes(buffer[value_start:line_end])
+
+            pos = eol + 1
+
+        if not data and event == b'message':
+            return None
+
+        return SSEEvent(
+            _KNOWN_EVENTS.get(event, UNKNOWN),
+            event.decode('utf-8', 'replace'),
+            data[0] if len(data) == 1 else b'\n'.join(data)
+        )
+
+
+def iter_events(chunks):
+    '''
+    Parses an iterable of raw byte chunks into SSEEvent objects.
+    '''
+    parser = SSEParser()
+
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+
+    yield from parser.flush()
+
+
+async def aiter_events(chunks):
+    '''
+    Parses an async iterable of raw byte chunks into SSEEvent objects.
+    '''
+    parser = SSEParser()
+
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+
+    for event in parser.flush():
+        yield event
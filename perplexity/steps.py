@@ -0,0 +1,118 @@
+# Importing necessary modules
+# json: Decode error type shared by all codecs
+# codec: JSON parsing of the nested answer payload
+import json
+
+from . import codec
+
+# Step types whose content carries the answer text, in order of preference
+ANSWER_STEP_TYPES = ('FINAL', 'ANSWER', 'FINAL_ANSWER', 'RESPONSE')
+
+# Step types whose content carries the web results
+SOURCE_STEP_TYPES = ('SEARCH_RESULTS',)
+
+
+class StepIndex:
+    '''
+    Maps each step_type of a search to the latest step of that type.
+
+    The index is updated with every snapshot as frames arrive, so the answer and the
+    sources are dictionary lookups instead of scans over the step list. The JSON document
+    nested in the FINAL step is decoded once per new FINAL step and then reused.
+    '''
+
+    def __init__(self, text=None):
+        self.steps = {}
+        self.text = None  # Non-list 'text' payloads (plain strings or answer objects)
+        self._final = None  # (step, decoded FINAL payload)
+
+        if text is not None:
+            self.update(text)
+
+    def update(self, text):
+        '''
+        Indexes the decoded 'text' field of a frame.
+        '''
+        if not isinstance(text, list):
+            self.text = text
+            return
+
+        steps = self.steps
+        for step in text:
+            if isinstance(step, dict):
+                steps[step.get('step_type')] = step
+
+    def get(self, step_type, default=None):
+        '''
+        Returns the latest step of the given type.
+        '''
+        return self.steps.get(step_type, default)
+
+    def _final_payload(self):
+        '''
+        Returns the decoded JSON document carried by the FINAL step, or None.
+        '''
+        step = self.steps.get('FINAL')
+        if step is None:
+            return None
+
+        if self._final is None or self._final[0] is not step:
+            content = step.get('content')
+            content = content.get('answer') if isinstance(content, dict) else content
+            payload = None
+
+            if isinstance(content, str) and content.startswith('{'):
+                try:
+                    payload = codec.loads(content)
+                except json.JSONDecodeError:
+                    pass
+
+            self._final = (step, payload if isinstance(payload, dict) else None)
+
+        return self._final[1]
+
+    @property
+    def answer(self):
+        '''
+        The answer text, or None.
+        '''
+        if isinstance(self.text, str):
+            return self.text
+
+        if isinstance(self.text, dict):
+            answer = self.text.get('answer')
+            return answer if isinstance(answer, str) else None
+
+        payload = self._final_payload()
+        if payload is not None and isinstance(payload.get('answer'), str):
+            return payload['answer']
+
+        for step_type in ANSWER_STEP_TYPES:
+            step = self.steps.get(step_type)
+            if step is None:
+                continue
+
+            content = step.get('content')
+            if isinstance(content, dict):
+                content = content.get('answer', content.get('text'))
+
+            if isinstance(content, str):
+                return content
+
+        return None
+
+    @property
+    def sources(self):
+        '''
+        The web results cited by the answer.
+        '''
+        payload = self._final_payload()
+        if payload is not None and payload.get('web_results'):
+            return payload['web_results']
+
+        for step_type in SOURCE_STEP_TYPES:
+            content = (self.steps.get(step_type) or {}).get('content')
+            if isinstance(content, dict) and content.get('web_results'):
+                return content['web_results']
+
+        return []
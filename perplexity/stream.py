@@ -0,0 +1,147 @@
+# Importing necessary modules
+# asyncio: Aborting the transfer of async responses
+# collections: Bounded ring buffer for retained snapshots
+import asyncio
+from collections import deque
+
+# Releases scheduled for requests cancelled before their headers arrived
+_pending_releases = set()
+
+
+def abort_response(resp):
+    '''
+    Stops a streamed sync response without waiting for its transfer thread.
+
+    The transfer stops at the next chunk it receives instead of reading the rest of the body,
+    and its curl handle is closed by the transfer thread once it has ended.
+    '''
+    quit_now = getattr(resp, 'quit_now', None)
+    task = getattr(resp, 'stream_task', None)
+
+    if quit_now is not None:
+        quit_now.set()
+
+    if task is not None and not task.done():
+        task.add_done_callback(lambda task: resp.close())
+    else:
+        resp.close()
+
+
+async def open_stream(request):
+    '''
+    Awaits a streamed async request.
+
+    When the caller is cancelled before the response headers arrive, the request is left
+    running until they do and the response is released right away, instead of being read
+    to the end by a transfer task nobody owns.
+    '''
+    task = asyncio.ensure_future(request)
+
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        task.add_done_callback(_release_cancelled)
+        raise
+
+
+def _release_cancelled(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+
+    release = asyncio.ensure_future(release_response(task.result()))
+    _pending_releases.add(release)
+    release.add_done_callback(_pending_releases.discard)
+
+
+async def release_response(resp):
+    '''
+    Aborts the transfer of a streamed async response and returns its curl handle to the session pool.
+    '''
+    task = getattr(resp, 'astream_task', None)
+
+    if task is not None and not task.done():
+        if resp.quit_now:
+            resp.quit_now.set()
+
+        # Cancelling the transfer task removes the handle from curl_multi and releases it
+        task.cancel()
+        await asyncio.wait([task])
+
+
+class SearchStream:
+    '''
+    Iterator over the frames of a streamed search.
+
+    Only the last max_chunks items are retained, so the memory held by an in-flight
+    search stays constant instead of growing with the length of the answer.
+    Passing max_chunks=None keeps every item.
+
+    Closing the stream closes the generator and the response it reads from, even when
+    iteration never started.
+    '''
+
+    def __init__(self, items, max_chunks=1, resp=None):
+        self.chunks = deque(maxlen=max_chunks)
+        self._items = items
+        self._resp = resp
+
+    @property
+    def latest(self):
+        '''
+        The most recent item, or None before the first one arrives.
+        '''
+        return self.chunks[-1] if self.chunks else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._items)
+        self.chunks.append(item)
+
+        return item
+
+    def close(self):
+        '''
+        Closes the underlying generator and response.
+        '''
+        self._items.close()
+
+        if self._resp is not None:
+            abort_response(self._resp)
+
+
+class AsyncSearchStream:
+    '''
+    Async iterator over the frames of a streamed search, see SearchStream.
+    '''
+
+    def __init__(self, items, max_chunks=1, resp=None):
+        self.chunks = deque(maxlen=max_chunks)
+        self._items = items
+        self._resp = resp
+
+    @property
+    def latest(self):
+        '''
+        The most recent item, or None before the first one arrives.
+        '''
+        return self.chunks[-1] if self.chunks else None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._items.__anext__()
+        self.chunks.append(item)
+
+        return item
+
+    async def aclose(self):
+        '''
+        Closes the underlying async generator and response.
+        '''
+        await self._items.aclose()
+
+        if self._resp is not None:
+            await release_response(self._resp)
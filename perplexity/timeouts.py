@@ -0,0 +1,238 @@
+# Importing necessary modules
+# re: Recognizing connect timeouts reported by libcurl
+# time: Monotonic clock for deadlines
+# queue: Waiting on the chunks of sync responses with a timeout
+# asyncio: Waiting on the chunks of async responses with a timeout
+# curl_cffi: Timeout errors reported by the transport
+import re
+import time
+import queue
+import asyncio
+from curl_cffi.requests.exceptions import Timeout as CurlTimeout
+
+# libcurl messages of timeouts that happen before the connection is established
+CONNECT_ERROR = re.compile(r'(?:Connection|Resolving) timed out')
+
+
+class SearchTimeout(TimeoutError):
+    '''
+    Base class of the timeouts raised by search and ask.
+
+    Attributes:
+    - timeout: The limit that was exceeded, in seconds.
+    '''
+
+    phase = 'request'
+
+    def __init__(self, timeout, message=None):
+        self.timeout = timeout
+
+        super().__init__(message or f'No {self.phase} within {timeout} seconds.')
+
+
+class ConnectTimeout(SearchTimeout):
+    '''
+    The connection could not be established in time.
+    '''
+
+    phase = 'connection'
+
+
+class FirstEventTimeout(SearchTimeout):
+    '''
+    The connection was established, but the first event did not arrive in time.
+    '''
+
+    phase = 'first event'
+
+
+class IdleTimeout(SearchTimeout):
+    '''
+    The stream stalled: no event arrived for too long after the previous one.
+    '''
+
+    phase = 'event'
+
+
+class TotalTimeout(SearchTimeout):
+    '''
+    The whole request took longer than its total deadline.
+    '''
+
+    phase = 'complete answer'
+
+
+class Timeouts:
+    '''
+    Phase timeouts of a search or a Labs query, in seconds. None disables a phase.
+
+    Parameters:
+    - connect: Establishing the connection (DNS, TCP and TLS).
+    - first_event: From sending the request until its first event arrives.
+    - idle: Between two consecutive events, so a stalled stream fails fast while a long
+      answer that keeps streaming is never cut off.
+    - total: The whole request, from sending it until the last event.
+    '''
+
+    def __init__(self, connect=10, first_event=60, idle=60, total=None):
+        self.connect = connect
+        self.first_event = first_event
+        self.idle = idle
+        self.total = total
+
+    def curl_timeout(self):
+        '''
+        The curl_cffi timeout of a streamed request, used as a backstop for stalled transfers.
+
+        curl_cffi turns (connect, read) into a connect timeout and aborts a stream that
+        receives nothing for connect + read seconds, the phase deadlines themselves are
+        enforced by Deadline.
+        '''
+        limits = [limit for limit in (self.first_event, self.idle, self.total) if limit is not None]
+
+        return (self.connect or 0, max(limits)) if limits else (self.connect or 0, 0)
+
+    def __repr__(self):
+        return f'Timeouts(connect={self.connect!r}, first_event={self.first_event!r}, idle={self.idle!r}, total={self.total!r})'
+
+
+class Deadline:
+    '''
+    Tracks the phase deadlines of one request from the moment it is sent.
+
+    Parameters:
+    - timeouts: The Timeouts of the request.
+    - origin: Monotonic time the total timeout counts from, when the request is a retry of an
+      earlier one. Defaults to now.
+    - started: Whether the request is sent now. A request waiting for a worker is created
+      with started=False and begin() is called once it is sent, only the total timeout
+      counts until then.
+    '''
+
+    def __init__(self, timeouts, origin=None, started=True):
+        self.timeouts = timeouts
+        now = time.monotonic()
+        self.start = now if started else None
+        self.origin = now if origin is None else origin
+        self.last_event = None
+
+    def begin(self):
+        '''
+        Starts the phase deadlines of a request created with started=False, when it is sent.
+        '''
+        self.start = time.monotonic()
+
+    def event(self):
+        '''
+        Records the arrival of an event.
+        '''
+        self.last_event = time.monotonic()
+
+    def remaining(self):
+        '''
+        Returns (seconds until the next deadline, exception raised when it passes), or (None, None) without deadlines.
+        '''
+        timeouts = self.timeouts
+        deadlines = []
+
+        if self.start is None:
+            pass  # Not sent yet
+        elif self.last_event is None:
+            if timeouts.first_event is not None:
+                deadlines.append((self.start + timeouts.first_event, FirstEventTimeout(timeouts.first_event)))
+        elif timeouts.idle is not None:
+            deadlines.append((self.last_event + timeouts.idle, IdleTimeout(timeouts.idle)))
+
+        if timeouts.total is not None:
+            deadlines.append((self.origin + timeouts.total, TotalTimeout(timeouts.total)))
+
+        if not deadlines:
+            return None, None
+
+        deadline, error = min(deadlines, key=lambda item: item[0])
+
+        return max(0.0, deadline - time.monotonic()), error
+
+    def check(self):
+        '''
+        Raises the timeout of the current phase if its deadline has passed.
+        '''
+        remaining, error = self.remaining()
+
+        if remaining is not None and remaining <= 0:
+            raise error
+
+    def transport_error(self, error):
+        '''
+        Converts a timeout reported by curl_cffi into the matching SearchTimeout.
+        '''
+        if CONNECT_ERROR.search(str(error)):
+            return ConnectTimeout(self.timeouts.connect)
+
+        if self.last_event is None:
+            return FirstEventTimeout(self.timeouts.first_event, f'No first event: {error}')
+
+        return IdleTimeout(self.timeouts.idle, f'Stream stalled: {error}')
+
+
+def iter_chunks(resp, deadline):
+    '''
+    Yields the body chunks of a streamed sync response, raising the SearchTimeout of the
+    current phase as soon as its deadline passes.
+
+    curl_cffi's iter_content blocks without a timeout, so the chunks are taken from the
+    response queue it reads from, which holds bytes, then an error or the end marker.
+    '''
+    chunks = getattr(resp, 'queue', None)
+
+    if chunks is None:
+        for chunk in resp.iter_content():
+            deadline.check()
+            yield chunk
+
+        return
+
+    while True:
+        remaining, error = deadline.remaining()
+
+        try:
+            chunk = chunks.get(timeout=remaining)
+        except queue.Empty:
+            raise error from None
+
+        if isinstance(chunk, CurlTimeout):
+            raise deadline.transport_error(chunk) from chunk
+
+        if isinstance(chunk, Exception):
+            raise chunk
+
+        # Anything else than bytes marks the end of the stream
+        if not isinstance(chunk, bytes):
+            return
+
+        yield chunk
+
+
+async def aiter_chunks(resp, deadline):
+    '''
+    Yields the body chunks of a streamed async response, raising the SearchTimeout of the
+    current phase as soon as its deadline passes.
+    '''
+    chunks = resp.aiter_content()
+
+    try:
+        while True:
+            remaining, error = deadline.remaining()
+
+            try:
+                chunk = await (asyncio.wait_for(chunks.__anext__(), remaining) if remaining is not None else chunks.__anext__())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise error from None
+            except CurlTimeout as e:
+                raise deadline.transport_error(e) from e
+
+            yield chunk
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,135 @@
+# Importing necessary modules
+# os: File sizes and path handling
+# re: Rewriting the URLs of uploaded images
+# hashlib: Content hashes for the upload cache
+# tempfile: Spooling file objects that are not backed by a file on disk
+import os
+import re
+import hashlib
+import tempfile
+
+# Upper bound on the number of attachments uploaded at the same time by one search
+MAX_UPLOAD_WORKERS = 4
+
+# Size of the reads used to spool file objects that are not backed by a file on disk
+CHUNK_SIZE = 1 << 20
+
+
+class UploadError(Exception):
+    '''
+    Raised when one or more attachments of a search could not be uploaded.
+
+    Attributes:
+    - errors: Dictionary mapping each failed filename to its exception.
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+
+        super().__init__(f'{len(errors)} file upload(s) failed: ' + ', '.join(f'{name} ({error!r})' for name, error in errors.items()))
+
+
+def file_part(file):
+    '''
+    Prepares a file of a search for upload.
+
+    Parameters:
+    - file: The file contents (bytes or str), a path (pathlib.Path or any os.PathLike) or a
+      binary or text file object.
+
+    Returns:
+    - A tuple (file_size, part), where part holds the keyword arguments of CurlMime.addpart,
+      and 'spooled' when local_path is a temporary file. Give it to release_part once uploaded.
+
+    Paths and file objects opened on a regular file are passed to libcurl as local_path, so
+    the file is read in chunks while it is sent instead of being copied into memory first.
+    Other file objects (pipes, BytesIO, files opened at an offset) are spooled from their
+    current position to a temporary file in chunks of CHUNK_SIZE, which is sent the same way.
+    '''
+    if isinstance(file, os.PathLike):
+        path = os.fspath(file)
+        return os.path.getsize(path), {'local_path': path}
+
+    if hasattr(file, 'read'):
+        path = getattr(file, 'name', None)
+
+        if isinstance(path, (str, bytes)) and os.path.isfile(path) and getattr(file, 'seekable', bool)() and file.tell() == 0:
+            return os.path.getsize(path), {'local_path': path}
+
+        return spool(file)
+
+    if isinstance(file, str):
+        file = file.encode('utf-8')
+
+    elif not isinstance(file, bytes):
+        file = bytes(file)
+
+    return len(file), {'data': file}
+
+
+def spool(file):
+    '''
+    Copies a file object from its current position to a temporary file, in chunks of CHUNK_SIZE.
+
+    Returns:
+    - A tuple (file_size, part) like file_part, with the temporary file as local_path.
+    '''
+    spooled = tempfile.NamedTemporaryFile('wb', prefix='perplexity-upload-', delete=False)
+    size = 0
+
+    try:
+        with spooled:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                spooled.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(spooled.name)
+        raise
+
+    return size, {'local_path': spooled.name, 'spooled': True}
+
+
+def release_part(part):
+    '''
+    Deletes the temporary file of a part spooled by file_part, once it was uploaded or is no longer needed.
+    '''
+    if part.pop('spooled', False):
+        try:
+            os.remove(part['local_path'])
+        except FileNotFoundError:
+            pass
+
+
+def file_digest(part):
+    '''
+    Returns the SHA-256 hex digest of a part prepared by file_part.
+    '''
+    if 'data' in part:
+        return hashlib.sha256(part['data']).hexdigest()
+
+    digest = hashlib.sha256()
+
+    with open(part['local_path'], 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def uploaded_url(file_upload_info, upload_resp):
+    '''
+    Returns the attachment URL of a finished upload.
+    '''
+    if 'image/upload' in file_upload_info['s3_object_url']:
+        return re.sub(
+            r'/private/s--.*?--/v\d+/user_uploads/',
+            '/private/user_uploads/',
+            upload_resp.json()['secure_url']
+        )
+
+    return file_upload_info['s3_object_url']
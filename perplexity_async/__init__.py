@@ -1,5 +1,10 @@
 from .client import Client
 from .emailnator import Emailnator
 from .labs import LabsClient
+from .pool import LabsClientPool
+from perplexity.cache import UploadCache
+from perplexity.timeouts import Timeouts, SearchTimeout, ConnectTimeout, FirstEventTimeout, IdleTimeout, TotalTimeout
+from perplexity.retry import RetryPolicy
+from perplexity.session import PoolLimits
 
-__all__ = ['Client', 'Emailnator', 'LabsClient']
\ No newline at end of file
+__all__ = ['Client', 'Emailnator', 'LabsClient', 'LabsClientPool', 'UploadCache', 'Timeouts', 'SearchTimeout', 'ConnectTimeout', 'FirstEventTimeout', 'IdleTimeout', 'TotalTimeout', 'RetryPolicy', 'PoolLimits']
\ No newline at end of file
@@ -1,11 +1,16 @@
-import re
-import sys
-import json
 import random
 import asyncio
-import mimetypes
-from uuid import uuid4
-from curl_cffi import requests, CurlMime
+from weakref import WeakSet
+
+from perplexity import sse, protocol
+from perplexity.delta import aiter_deltas
+from perplexity.stream import AsyncSearchStream, open_stream, release_response
+from perplexity.uploads import MAX_UPLOAD_WORKERS, UploadError, file_digest, release_part, uploaded_url
+from perplexity.cache import UploadCache
+from perplexity.batch import AsyncSearchBatch, aiter_batch
+from perplexity.session import AsyncSession
+from perplexity.timeouts import Timeouts, CurlTimeout, aiter_chunks
+from perplexity.retry import RetryPolicy, Attempt
 
 from .emailnator import Emailnator
 
@@ -33,45 +38,77 @@ class Client(AsyncMixin):
     '''
     A client for interacting with the Perplexity AI API.
     '''
-    async def __ainit__(self, cookies={}):
-        self.session = requests.AsyncSession(headers={
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'accept-language': 'en-US,en;q=0.9',
-            'cache-control': 'max-age=0',
-            'dnt': '1',
-            'priority': 'u=0, i',
-            'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
-            'sec-ch-ua-arch': '"x86"',
-            'sec-ch-ua-bitness': '"64"',
-            'sec-ch-ua-full-version': '"128.0.6613.120"',
-            'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-model': '""',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-ch-ua-platform-version': '"19.0.0"',
-            'sec-fetch-dest': 'document',
-            'sec-fetch-mode': 'navigate',
-            'sec-fetch-site': 'same-origin',
-            'sec-fetch-user': '?1',
-            'upgrade-insecure-requests': '1',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-        }, cookies=cookies, impersonate='chrome')
+    async def __ainit__(self, cookies={}, upload_cache=None, limits=None, timeouts=None, retry=None):
+        # One session is shared by every search of the client, see perplexity.session.PoolLimits for limits
+        self.session = AsyncSession(limits=limits, headers=protocol.HEADERS, cookies=cookies, impersonate='chrome')
         self.own = bool(cookies)
         self.copilot = 0 if not cookies else float('inf')
         self.file_upload = 0 if not cookies else float('inf')
-        self.signin_regex = re.compile(r'"(https://www\.perplexity\.ai/api/auth/callback/email\?callbackUrl=.*?)"')
+        self.upload_cache = UploadCache() if upload_cache is True else upload_cache
+        self.timeouts = timeouts or Timeouts()
+        self.retry = retry or RetryPolicy(attempts=1)
+        self.signin_regex = protocol.SIGNIN_REGEX
         self.timestamp = format(random.getrandbits(32), '08x')
-        await self.session.get('https://www.perplexity.ai/api/auth/session')
+        
+        # The session is bootstrapped on first use or by warmup(), not while awaiting the client
+        self.bootstrapped = False
+        self.bootstrap_lock = asyncio.Lock()
+        
+        # Search streams that are still open, closed together with the client
+        self.streams = WeakSet()
+    
+    async def __aenter__(self):
+        # Allows both "async with Client()" and "async with await Client()"
+        if not self.async_initialized:
+            await self
+        
+        return self
+    
+    async def __aexit__(self, *args):
+        await self.close()
+    
+    async def close(self):
+        '''
+        Closes the open search streams, releasing their responses, and the HTTP session
+        '''
+        for stream in list(self.streams):
+            try:
+                await stream.aclose()
+            except RuntimeError:
+                pass  # The stream is being read right now, closing the session below aborts it
+        
+        await self.session.close()
+    
+    async def warmup(self):
+        '''
+        Bootstraps the session (GET /api/auth/session) if that has not happened yet, and returns the client.
+        Clients can be warmed up in parallel with asyncio.gather(*(client.warmup() for client in clients)).
+        '''
+        async with self.bootstrap_lock:
+            if not self.bootstrapped:
+                await self.session.get(protocol.SESSION_URL)
+                self.bootstrapped = True
+        
+        return self
+    
+    @property
+    def stats(self):
+        '''
+        Connection reuse statistics of the shared session
+        '''
+        return self.session.stats
     
     async def create_account(self, cookies):
         '''
         Function to create a new account
         '''
+        await self.warmup()
+        
         while True:
             try:
                 emailnator_cli = await Emailnator(cookies)
                 
-                resp = await self.session.post('https://www.perplexity.ai/api/auth/signin/email', data={
+                resp = await self.session.post(protocol.SIGNIN_URL, data={
                     'email': emailnator_cli.email,
                     'csrfToken': self.session.cookies.get_dict()['next-auth.csrf-token'].split('%')[0],
                     'callbackUrl': 'https://www.perplexity.ai/',
@@ -99,133 +136,150 @@ class Client(AsyncMixin):
         
         return True
     
-    async def search(self, query, mode='auto', model=None, sources=['web'], files={}, stream=False, language='en-US', follow_up=None, incognito=False):
-        '''
-        Query function
-        '''
-        assert mode in ['auto', 'pro', 'reasoning', 'deep research'], 'Search modes -> ["auto", "pro", "reasoning", "deep research"]'
-        assert model in {
-            'auto': [None],
-            'pro': [None, 'sonar', 'gpt-4.5', 'gpt-4o', 'claude 3.7 sonnet', 'gemini 2.0 flash', 'grok-2'],
-            'reasoning': [None, 'r1', 'o3-mini', 'claude 3.7 sonnet'],
-            'deep research': [None]
-        }[mode] if self.own else True, '''Models for modes -> {
-    'auto': [None],
-    'pro': [None, 'sonar', 'gpt-4.5', 'gpt-4o', 'claude 3.7 sonnet', 'gemini 2.0 flash', 'grok-2'],
-    'reasoning': [None, 'r1', 'o3-mini', 'claude 3.7 sonnet'],
-    'deep research': [None]
-}'''
-        assert all([source in ('web', 'scholar', 'social') for source in sources]), 'Sources -> ["web", "scholar", "social"]'
-        assert self.copilot > 0 if mode in ['pro', 'reasoning', 'deep research'] else True, 'You have used all of your enhanced (pro) queries'
-        assert self.file_upload - len(files) >= 0 if files else True, f'You have tried to upload {len(files)} files but you have {self.file_upload} file upload(s) remaining.'
-        
-        self.copilot = self.copilot - 1 if mode in ['pro', 'reasoning', 'deep research'] else self.copilot
-        self.file_upload = self.file_upload - len(files) if files else self.file_upload
-        
-        uploaded_files = []
-        
-        for filename, file in files.items():
-            file_type = mimetypes.guess_type(filename)[0]
-            file_upload_info = (await self.session.post(
-                'https://www.perplexity.ai/rest/uploads/create_upload_url?version=2.18&source=default',
-                json={
-                    'content_type': file_type,
-                    'file_size': sys.getsizeof(file),
-                    'filename': filename,
-                    'force_image': False,
-                    'source': 'default',
-                }
-            )).json()
-
-            mp = CurlMime()
-            for key, value in file_upload_info['fields'].items():
-                mp.addpart(name=key, data=value)
-            mp.addpart(name='file', content_type=file_type, filename=filename, data=file)
-
-            upload_resp = await self.session.post(file_upload_info['s3_bucket_url'], multipart=mp)
+    def extract_answer(self, response_data):
+        '''
+        Extracts the final answer text from Perplexity response data
+        '''
+        return protocol.extract_answer(response_data)
+    
+    async def upload_file(self, filename, file):
+        '''
+        Uploads a single file and returns its attachment URL
+        '''
+        # Spooling file objects to disk is kept off the event loop
+        file_type, file_size, part = await asyncio.to_thread(protocol.upload_part, filename, file)
+        
+        try:
+            if self.upload_cache is not None:
+                # Hashing large files on disk is kept off the event loop
+                cache_key = self.upload_cache.key(await asyncio.to_thread(file_digest, part), filename, file_type)
+                cached_url = self.upload_cache.get(cache_key)
+                
+                if cached_url:
+                    return cached_url
             
-            if not upload_resp.ok:
-                raise Exception('File upload error', upload_resp)
-
-            if 'image/upload' in file_upload_info['s3_object_url']:
-                uploaded_url = re.sub(
-                    r'/private/s--.*?--/v\d+/user_uploads/',
-                    '/private/user_uploads/',
-                    upload_resp.json()['secure_url']
-                )
-            else:
-                uploaded_url = file_upload_info['s3_object_url']
-
-            uploaded_files.append(uploaded_url)
-        
-        json_data = {
-            'query_str': query,
-            'params':
-                {
-                    'attachments': uploaded_files + follow_up['attachments'] if follow_up else uploaded_files,
-                    'frontend_context_uuid': str(uuid4()),
-                    'frontend_uuid': str(uuid4()),
-                    'is_incognito': incognito,
-                    'language': language,
-                    'last_backend_uuid': follow_up['backend_uuid'] if follow_up else None,
-                    'mode': 'concise' if mode == 'auto' else 'copilot',
-                    'model_preference': {
-                        'auto': {
-                            None: 'turbo'
-                        },
-                        'pro': {
-                            None: 'pplx_pro',
-                            'sonar': 'experimental',
-                            'gpt-4.5': 'gpt45',
-                            'gpt-4o': 'gpt4o',
-                            'claude 3.7 sonnet': 'claude2',
-                            'gemini 2.0 flash': 'gemini2flash',
-                            'grok-2': 'grok'
-                        },
-                        'reasoning': {
-                            None: 'pplx_reasoning',
-                            'r1': 'r1',
-                            'o3-mini': 'o3mini',
-                            'claude 3.7 sonnet': 'claude37sonnetthinking'
-                        },
-                        'deep research': {
-                            None: 'pplx_alpha'
-                        }
-                    }[mode][model],
-                    'source': 'default',
-                    'sources': sources,
-                    'version': '2.18'
-                }
-            }
-        
-        resp = await self.session.post('https://www.perplexity.ai/rest/sse/perplexity_ask', json=json_data, stream=True)
-        chunks = []
+            file_upload_info = (await self.session.post(protocol.UPLOAD_URL, json=protocol.upload_url_payload(filename, file_type, file_size))).json()
+            mp = protocol.upload_multipart(file_upload_info, filename, file_type, part)
+            
+            upload_resp = await self.session.post(file_upload_info['s3_bucket_url'], multipart=mp)
+        finally:
+            release_part(part)
+        
+        if not upload_resp.ok:
+            raise Exception('File upload error', upload_resp)
+        
+        url = uploaded_url(file_upload_info, upload_resp)
+        
+        if self.upload_cache is not None:
+            self.upload_cache.set(cache_key, url)
+        
+        return url
+    
+    async def upload_files(self, files, max_workers=MAX_UPLOAD_WORKERS):
+        '''
+        Uploads files concurrently, at most max_workers at a time, and returns their attachment URLs in the order of files.
+        Raises UploadError with every failed upload once all of them have finished.
+        '''
+        semaphore = asyncio.Semaphore(max_workers)
+        
+        async def upload(filename, file):
+            async with semaphore:
+                return await self.upload_file(filename, file)
+        
+        results = await asyncio.gather(*[upload(filename, file) for filename, file in files.items()], return_exceptions=True)
+        errors = {filename: result for filename, result in zip(files, results) if isinstance(result, BaseException)}
+        
+        if errors:
+            raise UploadError(errors)
+        
+        return results
+    
+    def search_many(self, queries, concurrency=4, timeout=None, **kwargs):
+        '''
+        Runs a batch of searches, at most concurrency at a time, each cancelled after timeout seconds.
+        queries holds query strings or dictionaries of search arguments, kwargs are shared by all of them.
+        Returns an AsyncSearchBatch yielding a BatchResult per query in completion order, see summary() for failures.
+        '''
+        assert concurrency > 0, 'concurrency must be positive.'
+        
+        return AsyncSearchBatch(aiter_batch(self.search, queries, concurrency, timeout, kwargs))
+    
+    async def search(self, query, mode='auto', model=None, sources=['web'], files={}, stream=False, language='en-US', follow_up=None, incognito=False, delta=False, max_chunks=1, timeouts=None):
+        '''
+        Query function, returns a SearchResult or, with stream=True, an AsyncSearchStream of frames.
+        Raises a SearchTimeout subclass when one of the timeouts (defaults to the client's) is exceeded
+        '''
+        protocol.check_search(mode, model, sources, self.own, protocol.ASYNC_MESSAGES)
+        self.copilot, self.file_upload = protocol.charge_search(mode, files, self.copilot, self.file_upload, protocol.ASYNC_MESSAGES)
+        
+        # The session bootstrap runs concurrently with the file uploads
+        uploaded_files, _ = await asyncio.gather(self.upload_files(files), self.warmup())
+        
+        json_data = protocol.search_payload(query, mode, model, sources, uploaded_files, language, follow_up, incognito)
+        
+        # Failed or slow requests are retried or hedged by the policy until one produces its first event
+        attempt = await self.retry.arun(mode, lambda deadline: self._open_search(json_data, deadline), timeouts or self.timeouts, release_response)
+        resp, deadline = attempt.resp, attempt.deadline
+        
+        reader = protocol.SearchReader()
         
         async def stream_response(resp):
-            async for chunk in resp.aiter_lines(delimiter=b'\r\n\r\n'):
-                content = chunk.decode('utf-8')
-                
-                if content.startswith('event: message\r\n'):
-                    content_json = json.loads(content[len('event: message\r\ndata: '):])
-                    content_json['text'] = json.loads(content_json['text'])
+            try:
+                async for event in attempt:
+                    frame = reader.receive(event)
                     
-                    chunks.append(content_json)
-                    yield chunks[-1]
-                
-                elif content.startswith('event: end_of_stream\r\n'):
-                    return
+                    if frame is not None:
+                        deadline.event()
+                        yield frame
+                    
+                    if reader.done:
+                        return
+            finally:
+                await release_response(resp)
         
         if stream:
-            return stream_response(resp)
-        
-        async for chunk in resp.aiter_lines(delimiter=b'\r\n\r\n'):
-            content = chunk.decode('utf-8')
+            search_stream = AsyncSearchStream(aiter_deltas(stream_response(resp)) if delta else stream_response(resp), max_chunks, resp)
+            self.streams.add(search_stream)
             
-            if content.startswith('event: message\r\n'):
-                content_json = json.loads(content[len('event: message\r\ndata: '):])
-                content_json['text'] = json.loads(content_json['text'])
+            return search_stream
+        
+        try:
+            async for event in attempt:
+                if reader.receive(event) is not None:
+                    deadline.event()
                 
-                chunks.append(content_json)
-            
-            elif content.startswith('event: end_of_stream\r\n'):
-                return chunks[-1]
+                if reader.done:
+                    break
+        finally:
+            await release_response(resp)
+        
+        return reader.result()
+    
+    async def _open_search(self, json_data, deadline):
+        '''
+        Sends a search request and reads its stream up to the first event, returns an Attempt
+        '''
+        deadline.begin()
+        json_data = protocol.attempt_payload(json_data)
+        
+        # Cancellation while waiting for the headers still releases the response once they arrive
+        try:
+            resp = await open_stream(self.session.post(protocol.SEARCH_URL, json=json_data, stream=True, timeout=deadline.timeouts.curl_timeout()))
+        except CurlTimeout as e:
+            raise deadline.transport_error(e) from e
+        
+        events = sse.aiter_events(aiter_chunks(resp, deadline))
+        
+        try:
+            async for event in events:
+                if event.type == sse.MESSAGE:
+                    deadline.event()
+                    return Attempt(resp, deadline, event, events)
+                
+                elif event.type == sse.END_OF_STREAM:
+                    break
+        except BaseException:
+            await release_response(resp)
+            raise
+        
+        return Attempt(resp, deadline)
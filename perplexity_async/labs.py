@@ -1,11 +1,14 @@
-import ssl
 import json
-import socket
 import random
+import time
 import asyncio
-from threading import Thread
 from curl_cffi import requests
-from websocket import WebSocketApp, WebSocketException
+
+from perplexity import codec
+from perplexity.timeouts import Timeouts, ConnectTimeout, CurlTimeout
+from perplexity.multiplex import LabsRequest, LabsRouter, CLOSED, SENT
+from perplexity.history import History
+from perplexity.delta import aiter_deltas, LabsDeltaTracker
 
 
 class AsyncMixin:
@@ -30,140 +33,278 @@ class LabsClient(AsyncMixin):
     '''
     A client for interacting with the Perplexity AI Labs API.
     '''
-    async def __ainit__(self):
+    async def __ainit__(self, timeouts=None, history=None):
+        self.session = requests.AsyncSession(headers={
+            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+            'accept-language': 'en-US,en;q=0.9',
+            'cache-control': 'max-age=0',
+            'dnt': '1',
+            'priority': 'u=0, i',
+            'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
+            'sec-ch-ua-arch': '"x86"',
+            'sec-ch-ua-bitness': '"64"',
+            'sec-ch-ua-full-version': '"128.0.6613.120"',
+            'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-model': '""',
+            'sec-ch-ua-platform': '"Windows"',
+            'sec-ch-ua-platform-version': '"19.0.0"',
+            'sec-fetch-dest': 'document',
+            'sec-fetch-mode': 'navigate',
+            'sec-fetch-site': 'same-origin',
+            'sec-fetch-user': '?1',
+            'upgrade-insecure-requests': '1',
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
+        }, impersonate='chrome')
+        self.timestamp = format(random.getrandbits(32), '08x')
+        self.router = LabsRouter()  # Routes the answers to the queries running over the websocket
+        self.history = history if history is not None else History()  # See perplexity.history.History for windows
+        self.timeouts = timeouts or Timeouts()
+        
+        # The connection is set up on the first query or by warmup(), not while awaiting the client
+        self.ws = None
+        self.reader = None  # Task reading the websocket
+        self.connect_lock = asyncio.Lock()
+        self.closed = False
+        
+        # Seconds without any message after which the connection is considered dead, from the engine.io handshake
+        self.ping_timeout = None
+        self.last_message = None
+
+    async def __aenter__(self):
+        # Allows both "async with LabsClient()" and "async with await LabsClient()"
+        if not self.async_initialized:
+            await self
+        
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''
+        Closes the websocket, which ends its reader task, and the HTTP session.
+        Queries still waiting for an answer raise ConnectionError.
+        '''
+        self.closed = True
+        
+        # Wake up the queries waiting for an answer
+        self.router.close()
+        
+        async with self.connect_lock:
+            if self.ws is not None:
+                self.reader.cancel()
+                await self.ws.close()
+        
+        await self.session.close()
+
+    async def warmup(self):
+        '''
+        Sets up the Labs connection if that has not happened yet, and returns the client.
+        Clients can be warmed up in parallel with asyncio.gather(*(client.warmup() for client in clients)).
+        Raises ConnectTimeout, or the error of the HTTP session or websocket, when the connection fails
+        '''
+        if self.closed:
+            raise ConnectionError('The Labs client is closed.')
+        
+        async with self.connect_lock:
+            if self.ws is None:
+                await self._connect()
+        
+        return self
+
+    async def _connect(self):
+        '''
+        Opens the socket.io session and its WebSocket, raising ConnectTimeout after timeouts.connect seconds
+        '''
+        timeout = self.timeouts.connect
+        start = time.monotonic()
+        
         try:
-            self.session = requests.AsyncSession(headers={
-                'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-                'accept-language': 'en-US,en;q=0.9',
-                'cache-control': 'max-age=0',
-                'dnt': '1',
-                'priority': 'u=0, i',
-                'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
-                'sec-ch-ua-arch': '"x86"',
-                'sec-ch-ua-bitness': '"64"',
-                'sec-ch-ua-full-version': '"128.0.6613.120"',
-                'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-model': '""',
-                'sec-ch-ua-platform': '"Windows"',
-                'sec-ch-ua-platform-version': '"19.0.0"',
-                'sec-fetch-dest': 'document',
-                'sec-fetch-mode': 'navigate',
-                'sec-fetch-site': 'same-origin',
-                'sec-fetch-user': '?1',
-                'upgrade-insecure-requests': '1',
-                'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-            }, impersonate='chrome')
-            self.timestamp = format(random.getrandbits(32), '08x')
-            response = await self.session.get(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}')
+            response = await self.session.get(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}', timeout=timeout)
             response.raise_for_status()
-            self.sid = json.loads(response.text[1:])['sid']
-            self.last_answer = None
-            self.history = []
+            handshake = codec.loads(response.text[1:])
+            self.sid = handshake['sid']
+            self.ping_timeout = (handshake.get('pingInterval', 25000) + handshake.get('pingTimeout', 20000)) / 1000
 
-            post_response = await self.session.post(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}&sid={self.sid}', data='40{"jwt":"anonymous-ask-user"}')
+            post_response = await self.session.post(f'https://www.perplexity.ai/socket.io/?EIO=4&transport=polling&t={self.timestamp}&sid={self.sid}', data='40{"jwt":"anonymous-ask-user"}', timeout=timeout)
             post_response.raise_for_status()
             assert post_response.text == 'OK'
-
-            context = ssl.create_default_context()
-            context.minimum_version = ssl.TLSVersion.TLSv1_3
-            self.sock = context.wrap_socket(socket.create_connection(('www.perplexity.ai', 443)), server_hostname='www.perplexity.ai')
-
-            self.ws = WebSocketApp(
-                url=f'wss://www.perplexity.ai/socket.io/?EIO=4&transport=websocket&sid={self.sid}',
-                header={'User-Agent': self.session.headers['User-Agent']},
-                cookie='; '.join([f'{key}={value}' for key, value in self.session.cookies.get_dict().items()]),
-                on_open=lambda ws: (ws.send('2probe'), ws.send('5')),
-                on_message=self._on_message,
-                on_error=self._on_error,
-                socket=self.sock
+            
+            # The websocket runs on the event loop of the session, no thread is started for it
+            ws = await asyncio.wait_for(
+                self.session.ws_connect(f'wss://www.perplexity.ai/socket.io/?EIO=4&transport=websocket&sid={self.sid}'),
+                None if timeout is None else max(0, start + timeout - time.monotonic())
             )
+        except (CurlTimeout, asyncio.TimeoutError) as e:
+            raise ConnectTimeout(timeout) from e
+        
+        # Upgrade the socket.io session to the websocket transport
+        await ws.send_str('2probe')
+        await ws.send_str('5')
+        
+        self.last_message = time.monotonic()
+        self.ws = ws
+        self.reader = asyncio.create_task(self._read(ws))
 
-            Thread(target=self.ws.run_forever, daemon=True).start()
+    @property
+    def alive(self):
+        '''
+        Whether the websocket is open and the server pinged it recently enough for a query sent now to be answered.
+        A client with a query that passed its deadline without a final answer is not alive either
+        '''
+        if self.closed or self.ws is None or self.router.stuck():
+            return False
+        
+        return time.monotonic() - self.last_message < self.ping_timeout
 
-            while not (self.ws.sock and self.ws.sock.connected):
-                await asyncio.sleep(0.01)
-        except (requests.RequestException, WebSocketException, socket.error, ssl.SSLError) as e:
-            print(f"Initialization error: {e}")
+    async def _read(self, ws):
+        '''
+        Hands every websocket message to _on_message until the connection ends
+        '''
+        try:
+            while True:
+                await self._on_message(ws, await ws.recv_str())
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Unexpected error during initialization: {e}")
+            if not self.closed:
+                print(f'Websocket Error: {e}')
+        finally:
+            # No answer can arrive anymore, so the waiting queries fail instead of timing out
+            self.closed = True
+            self.router.close()
 
-    def _on_message(self, ws, message):
+    async def _on_message(self, ws, message):
         '''
         Websocket message handler
         '''
+        self.last_message = time.monotonic()
+        
         try:
             if message == '2':
-                ws.send('3')
+                await ws.send_str('3')
                 
             if message.startswith('42'):
-                response = json.loads(message[2:])[1]
+                event, response = codec.loads(message[2:])[:2]
                 
                 if 'final' in response:
-                    self.last_answer = response
+                    request = self.router.route(event, response)
+                    
+                    # The next query of the same model is sent once this answer is final
+                    if request is not None:
+                        await self._submit(request)
         except json.JSONDecodeError as e:
             print(f"JSON decode error: {e}")
         except Exception as e:
             print(f"Unexpected error in message handler: {e}")
 
-    def _on_error(self, ws, error):
+    async def _send(self, request):
+        '''
+        Sends a query via websocket
+        '''
+        # The conversation is already encoded, so only the model is serialized here
+        await self.ws.send_str(f'42["perplexity_labs",{{"messages":{request.messages},"model":{codec.dumps(request.model)},"source":"default","version":"2.18"}}]')
+
+    async def _submit(self, request):
         '''
-        Websocket error handler
+        Sends a query, withdrawing it from the router when the websocket fails so the queries after it still run
         '''
-        print(f'Websocket Error: {error}')
+        while request is not None:
+            try:
+                await self._send(request)
+                return
+            except Exception as e:
+                failed, request = request, self.router.withdraw(request)
+                failed.answers.put_nowait(e)
 
-    async def ask(self, query, model='r1-1776', stream=False):
+    async def _answers(self, request):
         '''
-        Query function
+        Yields the answers of a query up to the final one, which is recorded in the history. Raises the timeout
+        of the current phase once its deadline passes or ConnectionError when the client is closed. The deadline
+        starts when the query is sent, not while it waits behind a query of the same model
         '''
         try:
-            assert model in ['r1-1776', 'sonar-pro', 'sonar', 'sonar-reasoning-pro', 'sonar-reasoning'], 'Search models -> ["r1-1776", "sonar-pro", "sonar", "sonar-reasoning-pro", "sonar-reasoning"]'
-            
-            self.last_answer = None
-            self.history.append({'role': 'user', 'content': query})
-            
-            self.ws.send('42' + json.dumps([
-                'perplexity_labs',
-                {
-                    'messages': self.history,
-                    'model': model,
-                    'source': 'default',
-                    'version': '2.18',
-                }
-            ]))
-            
-            async def stream_response(self):
-                answer = None
-                
-                while True:
-                    if self.last_answer != answer:
-                        answer = self.last_answer
-                        yield answer
-                    
-                    if self.last_answer and self.last_answer.get('final'):
-                        answer = self.last_answer
-                        self.last_answer = None
-                        self.history.append({'role': 'assistant', 'content': answer['output'], 'priority': 0})
-                        
-                        return
-                    
-                    await asyncio.sleep(0.01)
-            
             while True:
-                if self.last_answer and stream:
-                    return stream_response(self)
+                deadline = request.deadline
+                remaining, error = deadline.remaining() if deadline is not None else (self.router.wait_time(request), None)
+                
+                if deadline is not None and remaining is not None and remaining <= 0:
+                    raise error
                 
-                elif self.last_answer and self.last_answer.get('final'):
-                    answer = self.last_answer
-                    self.last_answer = None
-                    self.history.append({'role': 'assistant', 'content': answer['output'], 'priority': 0})
+                try:
+                    answer = await asyncio.wait_for(request.answers.get(), remaining)
+                except asyncio.TimeoutError:
+                    # The query in flight ahead of this one passed its deadline, its lane is freed
+                    if deadline is None:
+                        for send in self.router.expire():
+                            await self._submit(send)
                     
-                    return answer
+                    continue
                 
-                await asyncio.sleep(0.01)
-        except AssertionError as e:
-            print(f"Assertion error: {e}")
-        except WebSocketException as e:
-            print(f"WebSocket error: {e}")
-        except Exception as e:
-            print(f"Unexpected error in ask method: {e}")
\ No newline at end of file
+                if answer is SENT:
+                    continue
+                
+                if answer is CLOSED:
+                    raise ConnectionError('The Labs client was closed before the answer arrived.')
+                
+                # The query could not be sent
+                if isinstance(answer, Exception):
+                    raise answer
+                
+                if answer.get('final'):
+                    self.history.extend((request.message, {'role': 'assistant', 'content': answer['output'], 'priority': 0}))
+                    yield answer
+                    return
+                
+                yield answer
+        finally:
+            # A query given up early stops receiving answers, one that timed out frees its lane
+            send = self.router.abandon(request)
+            
+            if send is not None:
+                await self._submit(send)
+
+    async def ask(self, query, model='r1-1776', stream=False, timeouts=None, delta=False):
+        '''
+        Query function, raises a SearchTimeout subclass when one of the timeouts (defaults to the client's) is exceeded
+        and ConnectionError when the client is closed or the websocket drops before the answer arrives.
+        Queries can run concurrently over the same websocket, those of the same model are sent one after the other.
+        With stream and delta, only the newly appended output and the fields that changed are yielded
+        '''
+        assert model in ['r1-1776', 'sonar-pro', 'sonar', 'sonar-reasoning-pro', 'sonar-reasoning'], 'Search models -> ["r1-1776", "sonar-pro", "sonar", "sonar-reasoning-pro", "sonar-reasoning"]'
+        
+        # Like in the sync client, invalid models, connection failures, closed clients and timeouts are raised to the caller
+        await self.warmup()
+        
+        if self.closed or self.ws is None:
+            raise ConnectionError('The Labs client is closed.')
+        
+        # The history is only extended once the answer is final, so concurrent queries do not interleave their turns
+        message = {'role': 'user', 'content': query}
+        request = LabsRequest(model, message, self.history.encode(message), asyncio.Queue(), timeouts or self.timeouts)
+        
+        if self.router.submit(request) is not None:
+            await self._submit(request)
+        
+        answers = self._answers(request)
+        
+        async def stream_response(answer):
+            try:
+                yield answer
+                
+                async for answer in answers:
+                    yield answer
+            finally:
+                await answers.aclose()
+        
+        if stream:
+            # The stream is returned once the first answer arrived
+            response = stream_response(await answers.__anext__())
+            
+            return aiter_deltas(response, LabsDeltaTracker()) if delta else response
+        
+        async for answer in answers:
+            pass
+        
+        return answer
\ No newline at end of file
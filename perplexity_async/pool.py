@@ -0,0 +1,203 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .labs import LabsClient
+
+
+class LabsClientPool:
+    '''
+    A pool of connected LabsClient sessions leased to callers, see perplexity.pool.LabsClientPool.
+    Create it inside the event loop, the clients are connected by tasks of that loop.
+    '''
+    def __init__(self, size=4, timeouts=None, check_interval=5, connect_concurrency=2, backoff=1, max_backoff=30):
+        assert size > 0, 'size must be positive.'
+        assert connect_concurrency > 0, 'connect_concurrency must be positive.'
+
+        self.size = size
+        self.timeouts = timeouts
+        self.check_interval = check_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.idle = deque()
+        self.leased = set()
+        self.available = asyncio.Condition()  # Notified when a client becomes idle or the pool is closed
+        self.closed = False
+
+        # Bounds the number of handshakes running at the same time
+        self.connecting = asyncio.Semaphore(connect_concurrency)
+        self.tasks = set()
+
+        for _ in range(size):
+            self._spawn(self._connect())
+
+        self._spawn(self._check())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''
+        Closes every client of the pool, leased ones included. Waiting leases raise ConnectionError
+        '''
+        async with self.available:
+            self.closed = True
+            clients = list(self.idle) + list(self.leased)
+            self.idle.clear()
+            self.leased.clear()
+            self.available.notify_all()
+
+        for task in list(self.tasks):
+            task.cancel()
+
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _connect(self):
+        '''
+        Connects a new client and makes it idle, retrying with backoff until it succeeds or the pool is closed
+        '''
+        delay = self.backoff
+
+        while not self.closed:
+            client = await LabsClient(self.timeouts)
+            kept = False
+
+            try:
+                async with self.connecting:
+                    await client.warmup()
+
+                async with self.available:
+                    if not self.closed:
+                        self.idle.append(client)
+                        self.available.notify()
+                        kept = True
+
+                return
+            except Exception:
+                pass
+            finally:
+                # A client that failed, was cancelled by close() or is no longer needed is not leaked
+                if not kept:
+                    await client.close()
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    async def _replace(self, client):
+        '''
+        Closes a dead client and connects another one in its place
+        '''
+        if not self.closed:
+            self._spawn(self._connect())
+
+        await client.close()
+
+    async def _check(self):
+        '''
+        Replaces the idle clients that are no longer alive, every check_interval seconds
+        '''
+        while True:
+            await asyncio.sleep(self.check_interval)
+
+            async with self.available:
+                dead = [client for client in self.idle if not client.alive]
+
+                for client in dead:
+                    self.idle.remove(client)
+
+            for client in dead:
+                await self._replace(client)
+
+    async def acquire(self, timeout=None):
+        '''
+        Takes a connected client out of the pool, waiting at most timeout seconds for an idle one.
+        Raises TimeoutError when no client became idle in time, ConnectionError when the pool is closed
+        '''
+        while True:
+            async with self.available:
+                try:
+                    await asyncio.wait_for(self.available.wait_for(lambda: self.idle or self.closed), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f'No Labs client became available within {timeout} seconds.')
+
+                if self.closed:
+                    raise ConnectionError('The Labs client pool is closed.')
+
+                client = self.idle.popleft()
+
+                if client.alive:
+                    self.leased.add(client)
+                    return client
+
+            # A client that died since the last health check is replaced and the next one is tried
+            await self._replace(client)
+
+    async def release(self, client):
+        '''
+        Gives a client back to the pool with a cleared history, one that is no longer alive is replaced
+        '''
+        client.history.clear()
+
+        async with self.available:
+            self.leased.discard(client)
+
+            if client.alive and not self.closed:
+                self.idle.append(client)
+                self.available.notify()
+                return
+
+        await self._replace(client)
+
+    @asynccontextmanager
+    async def lease(self, timeout=None):
+        '''
+        Async context manager leasing a connected client, given back to the pool on exit
+        '''
+        client = await self.acquire(timeout)
+
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    async def ask(self, query, model='r1-1776', stream=False, timeouts=None, lease_timeout=None, delta=False):
+        '''
+        Sends a query on a leased client, see LabsClient.ask. A stream keeps its client until it is exhausted or closed
+        '''
+        if not stream:
+            async with self.lease(lease_timeout) as client:
+                return await client.ask(query, model=model, timeouts=timeouts)
+
+        client = await self.acquire(lease_timeout)
+
+        try:
+            answers = await client.ask(query, model=model, stream=True, timeouts=timeouts, delta=delta)
+        except BaseException:
+            await self.release(client)
+            raise
+
+        async def stream_response():
+            try:
+                if answers is not None:
+                    async for answer in answers:
+                        yield answer
+            finally:
+                await self.release(client)
+
+        return stream_response()
+
+    @property
+    def stats(self):
+        '''
+        Dictionary with the number of idle and leased clients
+        '''
+        return {'idle': len(self.idle), 'leased': len(self.leased)}